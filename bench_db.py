@@ -0,0 +1,92 @@
+# Файл: bench_db.py (замер задержки записи сканов: "до" и "после" пула соединений и групповой записи)
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import aiosqlite
+
+import database as db
+
+
+async def legacy_scan(db_path: Path, user_id: int, scooter_number: str):
+    """Старый путь: по отдельному соединению и коммиту на запись скана и на активность."""
+    timestamp_str = db.now_moscow().isoformat()
+    async with aiosqlite.connect(db_path) as conn:
+        await conn.execute(
+            "INSERT INTO scooter_log (user_id, scooter_number, timestamp, day) VALUES (?, ?, ?, ?)",
+            (user_id, scooter_number, timestamp_str, timestamp_str[:10])
+        )
+        await conn.commit()
+    async with aiosqlite.connect(db_path) as conn:
+        await conn.execute(
+            "INSERT OR REPLACE INTO activity (user_id, last_seen_date) VALUES (?, ?)",
+            (user_id, db.now_moscow().strftime("%Y-%m-%d"))
+        )
+        await conn.commit()
+
+
+async def pooled_scan(db_path: Path, user_id: int, scooter_number: str):
+    """Новый путь: очередь записи модуля database, скан и активность в одной транзакции."""
+    await db.add_scooter(user_id, scooter_number)
+
+
+async def measure(scan, db_path: Path, scans: int, users: int) -> list:
+    latencies = []
+    for i in range(scans):
+        started = time.perf_counter()
+        await scan(db_path, 1000 + i % users, f"{i:08d}")
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+async def measure_burst(scan, db_path: Path, scans: int, users: int) -> tuple:
+    """
+    Все сканы приходят одновременно, как после выгрузки смены.
+    Возвращает общее время в мс и число сканов, упавших с "database is locked".
+    """
+    started = time.perf_counter()
+    results = await asyncio.gather(*(scan(db_path, 1000 + i % users, f"{i:08d}") for i in range(scans)),
+                                   return_exceptions=True)
+    failed = sum(isinstance(result, Exception) for result in results)
+    return (time.perf_counter() - started) * 1000, failed
+
+
+def report(title: str, latencies: list):
+    ordered = sorted(latencies)
+    p95 = ordered[int(len(ordered) * 0.95) - 1]
+    print(f"{title:<10} среднее {statistics.mean(ordered):7.3f} мс | "
+          f"медиана {statistics.median(ordered):7.3f} мс | p95 {p95:7.3f} мс")
+
+
+async def run(scans: int, users: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "bench.db"
+        await db.init_db(db_path)
+        try:
+            # Прогрев, чтобы не мерить создание файла и первое чтение схемы
+            await measure(pooled_scan, db_path, 10, users)
+            legacy = await measure(legacy_scan, db_path, scans, users)
+            pooled = await measure(pooled_scan, db_path, scans, users)
+            legacy_burst = await measure_burst(legacy_scan, db_path, scans, users)
+            pooled_burst = await measure_burst(pooled_scan, db_path, scans, users)
+        finally:
+            await db.close_db()
+
+    print(f"Сканов: {scans}, пользователей: {users}")
+    report("до", legacy)
+    report("после", pooled)
+    print(f"Ускорение по медиане: x{statistics.median(legacy) / statistics.median(pooled):.1f}")
+    print(f"Одновременная пачка из {scans} сканов: "
+          f"до {legacy_burst[0]:.0f} мс (ошибок: {legacy_burst[1]}), после {pooled_burst[0]:.0f} мс (ошибок: {pooled_burst[1]})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Задержка записи одного скана в SQLite.")
+    parser.add_argument("--scans", type=int, default=500)
+    parser.add_argument("--users", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.scans, args.users))
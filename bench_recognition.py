@@ -0,0 +1,207 @@
+# Файл: bench_recognition.py (скорость и точность распознавания номера на синтетических фото из data/info_photos)
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import config
+import recognition
+
+SOURCE_PHOTOS = ("1 QR.jpg", "2 Nomer Text.jpg", "2 Nomer Zad.jpg")
+# Номера, которые видны на примерах из data/info_photos; --expected подменяет их своими
+EXPECTED_NUMBERS = {"1 QR.jpg": "00259825", "2 Nomer Text.jpg": "00666999", "2 Nomer Zad.jpg": "00247094"}
+
+
+def _rotate_small(image, angle: float):
+    h, w = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(image, matrix, (w, h), borderMode=cv2.BORDER_REPLICATE)
+
+
+def _glare(image, strength: float = 0.8):
+    """Блик: яркое размытое пятно в правой верхней трети кадра, как от лампы или солнца."""
+    h, w = image.shape[:2]
+    mask = np.zeros((h, w), np.float32)
+    cv2.ellipse(mask, (int(w * 0.65), int(h * 0.35)), (w // 5, h // 7), 30, 0, 360, 1.0, -1)
+    mask = cv2.GaussianBlur(mask, (0, 0), sigmaX=w / 20)[..., None] * strength
+    return (image * (1 - mask) + 255 * mask).astype(np.uint8)
+
+
+def _jpeg(image, quality: int):
+    return cv2.imdecode(cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1], cv2.IMREAD_COLOR)
+
+
+# Искажения корпуса: имя -> функция над BGR-кадром
+DISTORTIONS = {
+    "original": lambda img: img,
+    "rot90": lambda img: cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE),
+    "rot180": lambda img: cv2.rotate(img, cv2.ROTATE_180),
+    "rot270": lambda img: cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE),
+    "tilt+8": lambda img: _rotate_small(img, 8),
+    "tilt-15": lambda img: _rotate_small(img, -15),
+    "blur3": lambda img: cv2.GaussianBlur(img, (0, 0), 1.5),
+    "blur6": lambda img: cv2.GaussianBlur(img, (0, 0), 3.0),
+    "glare": _glare,
+    "scale0.5": lambda img: cv2.resize(img, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA),
+    "scale2": lambda img: cv2.resize(img, None, fx=2.0, fy=2.0, interpolation=cv2.INTER_CUBIC),
+    "jpeg30": lambda img: _jpeg(img, 30),
+    "jpeg10": lambda img: _jpeg(img, 10),
+    "blur3+jpeg30": lambda img: _jpeg(cv2.GaussianBlur(img, (0, 0), 1.5), 30),
+    "rot90+glare": lambda img: _glare(cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)),
+}
+
+
+def build_corpus(photos_dir) -> List[Tuple[str, str, bytes]]:
+    """Список (фото, искажение, JPEG-байты). Байты сжаты как у Telegram, чтобы замер включал декодирование."""
+    corpus = []
+    for filename in SOURCE_PHOTOS:
+        image = cv2.imread(str(photos_dir / filename))
+        if image is None:
+            print(f"Пропускаю {filename}: файл не найден или не читается.")
+            continue
+        for name, distort in DISTORTIONS.items():
+            ok, encoded = cv2.imencode(".jpg", distort(image), [cv2.IMWRITE_JPEG_QUALITY, 87])
+            corpus.append((filename, name, encoded.tobytes()))
+    return corpus
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def run_single(corpus, rounds: int) -> List[Dict]:
+    """Распознавание в текущем процессе: чистое время одного ядра по этапам."""
+    results = []
+    for _ in range(rounds):
+        for filename, distortion, data in corpus:
+            timings: Dict[str, float] = {}
+            started = time.perf_counter()
+            image = recognition.decode_image(data)
+            timings["decode"] = (time.perf_counter() - started) * 1000
+            number = recognition.extract_number_from_image(image, timings)
+            results.append({"photo": filename, "distortion": distortion, "number": number,
+                            "total_ms": sum(timings.values()), "timings": timings})
+    return results
+
+
+async def run_pool(corpus, workers: int, rounds: int) -> float:
+    """
+    Пропускная способность пула процессов: фото отправляются одновременно, но не больше OCR_QUEUE_LIMIT сразу,
+    как и в боте. Возвращает фото/с.
+    """
+    recognition.start_recognition_pool(workers)
+    slots = asyncio.Semaphore(config.OCR_QUEUE_LIMIT)
+
+    async def recognize(data: bytes):
+        async with slots:
+            return await recognition.recognize_number(data)
+
+    try:
+        jobs = [data for _ in range(rounds) for _, _, data in corpus]
+        started = time.perf_counter()
+        await asyncio.gather(*(recognize(data) for data in jobs))
+        return len(jobs) / (time.perf_counter() - started)
+    finally:
+        recognition.shutdown_recognition_pool()
+
+
+def summarize(results: List[Dict], expected: Dict[str, str]) -> Dict:
+    totals = [r["total_ms"] for r in results]
+    stages: Dict[str, List[float]] = {}
+    found_at: Dict[str, int] = {}
+    for r in results:
+        for stage, ms in r["timings"].items():
+            stages.setdefault(stage, []).append(ms)
+        if r["number"]:
+            last_stage = list(r["timings"])[-1]
+            found_at[last_stage] = found_at.get(last_stage, 0) + 1
+
+    correct: Dict[str, List[int]] = {}
+    for r in results:
+        hits = correct.setdefault(r["distortion"], [0, 0])
+        hits[0] += r["number"] == expected.get(r["photo"])
+        hits[1] += 1
+
+    return {
+        "photos": len(results),
+        "latency_ms": {"p50": percentile(totals, 0.5), "p95": percentile(totals, 0.95),
+                       "max": max(totals), "mean": statistics.mean(totals)},
+        "throughput_per_core": 1000 / statistics.mean(totals),
+        "stages_ms": {stage: {"runs": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95)}
+                      for stage, values in stages.items()},
+        "found_at_stage": found_at,
+        "accuracy": sum(h[0] for h in correct.values()) / len(results),
+        "accuracy_by_distortion": {name: h[0] / h[1] for name, h in correct.items()},
+    }
+
+
+def report(summary: Dict, baseline: Optional[Dict]):
+    latency = summary["latency_ms"]
+    print(f"Фото: {summary['photos']} | медиана {latency['p50']:.1f} мс | p95 {latency['p95']:.1f} мс | "
+          f"макс {latency['max']:.1f} мс | {summary['throughput_per_core']:.1f} фото/с на ядро")
+    if "pool" in summary:
+        pool = summary["pool"]
+        print(f"Пул из {pool['workers']} процессов: {pool['photos_per_sec']:.1f} фото/с "
+              f"({pool['photos_per_sec'] / pool['workers']:.1f} на процесс)")
+    print("Этапы (запусков, p50, p95):")
+    for stage, values in summary["stages_ms"].items():
+        print(f"  {stage:<10} {values['runs']:>5} {values['p50']:8.1f} мс {values['p95']:8.1f} мс")
+    print(f"Где найден номер: {summary['found_at_stage']}")
+    print(f"Точность: {summary['accuracy']:.1%}")
+    for name, value in summary["accuracy_by_distortion"].items():
+        print(f"  {name:<14} {value:.0%}")
+    if baseline:
+        print(f"Сравнение с прошлым прогоном: медиана {baseline['latency_ms']['p50']:.1f} -> {latency['p50']:.1f} мс, "
+              f"точность {baseline['accuracy']:.1%} -> {summary['accuracy']:.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость и точность распознавания номера на синтетических фото.")
+    parser.add_argument("--rounds", type=int, default=3, help="Сколько раз прогнать корпус")
+    parser.add_argument("--workers", type=int, default=0, help="Замерить еще и пул из стольких процессов")
+    parser.add_argument("--expected", help="JSON {файл: номер} вместо встроенных номеров примеров")
+    parser.add_argument("--output", default="bench_recognition.json", help="Куда сохранить результаты")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    expected = dict(EXPECTED_NUMBERS)
+    if args.expected:
+        with open(args.expected, encoding="utf-8") as f:
+            expected.update(json.load(f))
+
+    # Замер в этом процессе должен идти в тех же условиях, что в рабочем процессе пула
+    recognition._init_worker(config.TESSERACT_CMD)
+    corpus = build_corpus(config.INFO_PHOTOS_DIR)
+    if not corpus:
+        print("Нет фото для корпуса.")
+        return
+    recognition.extract_number_from_image(recognition.decode_image(corpus[0][2]))  # Прогрев
+
+    results = run_single(corpus, args.rounds)
+    summary = summarize(results, expected)
+    if args.workers:
+        summary["pool"] = {"workers": args.workers,
+                           "photos_per_sec": asyncio.run(run_pool(corpus, args.workers, args.rounds))}
+    summary["cpu_count"] = os.cpu_count()
+    summary["results"] = results
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    report(summary, baseline)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
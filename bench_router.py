@@ -0,0 +1,112 @@
+# Файл: bench_router.py (пропускная способность маршрутизации текста: цепочка regex-фильтров против TextRouter)
+
+import argparse
+import random
+import re
+import time
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import MessageHandler, filters
+
+import config
+import router
+from recognition import NUMBER_PATTERN
+
+BUTTONS = [config.BUTTON_MY_SHIFTS, config.BUTTON_RETURN, config.BUTTON_CONTACT_ADMIN, config.BUTTON_TABLE,
+           config.BUTTON_VYGRUZKA, config.BUTTON_TODAY_REPORT, config.BUTTON_DEKADA_1, config.BUTTON_DEKADA_2,
+           config.BUTTON_DEKADA_3, config.BUTTON_BROADCAST, config.BUTTON_ACCEPT_BROADCAST,
+           config.BUTTON_SKIP_BROADCAST, config.BUTTON_INFO]
+
+
+async def _noop(update, context):
+    pass
+
+
+async def _handle_text(update, context):
+    pass
+
+
+def make_updates(count: int, users: int, seed: int = 1) -> list:
+    """Поток сообщений как в рабочий день: в основном номера самокатов, кнопки и немного прочего текста."""
+    rng = random.Random(seed)
+    date = datetime.now(timezone.utc)
+    updates = []
+    for i in range(count):
+        user_id = 1000 + rng.randrange(users)
+        roll = rng.random()
+        if roll < 0.7:
+            text = f"00{rng.randrange(10 ** 6):06d}"
+        elif roll < 0.95:
+            text = rng.choice(BUTTONS)
+        else:
+            text = "спасибо"
+        user = User(id=user_id, first_name="Test", is_bot=False)
+        message = Message(message_id=i, date=date, chat=Chat(id=user_id, type="private"), from_user=user, text=text)
+        updates.append(Update(update_id=i, message=message))
+    return updates
+
+
+def legacy_route(handlers, user_data, update):
+    """Старый путь: обработчики по очереди проверяют фильтры, затем handle_text_message ищет номер дважды."""
+    for handler in handlers:
+        if handler.check_update(update):
+            break
+    if handler is not handlers[-1]:
+        return handler.callback
+    user_id, text = update.message.from_user.id, update.message.text
+    if str(user_id) not in user_data or text == config.BUTTON_MY_STATS:
+        return None
+    if NUMBER_PATTERN.search(text):
+        return NUMBER_PATTERN.search(text).group(0)
+    all_buttons = list(BUTTONS)
+    return text not in all_buttons
+
+
+def router_route(text_handler, text_router, update):
+    """Новый путь: один фильтр TEXT & ~COMMAND, словарь кнопок и один поиск номера."""
+    if not text_handler.check_update(update):
+        return None
+    callback = text_router.resolve(update.effective_chat.id, update.message.text)
+    if callback is _handle_text and (match := NUMBER_PATTERN.search(update.message.text)):
+        return match.group(0)
+    return callback
+
+
+def measure(route, updates, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for update in updates:
+            route(update)
+    return len(updates) * repeat / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сколько текстовых сообщений в секунду проходит маршрутизацию.")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    user_data = {str(1000 + i): {"permissions": "user"} for i in range(args.users)}
+    chat_ids = [int(uid) for uid in user_data]
+    legacy_handlers = [
+        MessageHandler(filters.TEXT & filters.Regex(f"^{re.escape(text)}$") & filters.Chat(chat_id=chat_ids), _noop)
+        for text in BUTTONS
+    ] + [MessageHandler(filters.TEXT & ~filters.COMMAND, _noop)]
+    text_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, _noop)
+    text_router = router.TextRouter({text: _noop for text in BUTTONS}, _handle_text, frozenset(chat_ids).__contains__)
+
+    updates = make_updates(args.updates, args.users)
+    measure(lambda u: router_route(text_handler, text_router, u), updates, 1)  # Прогрев
+    legacy = measure(lambda u: legacy_route(legacy_handlers, user_data, u), updates, args.repeat)
+    routed = measure(lambda u: router_route(text_handler, text_router, u), updates, args.repeat)
+
+    print(f"Сообщений: {args.updates} x {args.repeat}, пользователей: {args.users}")
+    print(f"до    {legacy:10.0f} сообщений/с")
+    print(f"после {routed:10.0f} сообщений/с")
+    print(f"Ускорение: x{routed / legacy:.1f}")
+
+
+if __name__ == "__main__":
+    main()
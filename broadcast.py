@@ -0,0 +1,231 @@
+# Файл: broadcast.py (рассылка сообщений сотрудникам в пределах лимитов Telegram)
+
+import asyncio
+import itertools
+import logging
+import time
+from bisect import insort
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Set
+
+from telegram import Bot, Message
+from telegram.error import RetryAfter, TimedOut
+
+import config
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты "ведро с токенами": не больше rate запросов в секунду в среднем
+    и не больше capacity подряд. pause() останавливает выдачу, когда Telegram ответил 429.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Лимиты общие для всех рассылок процесса: Telegram считает их на бота, а не на рассылку.
+_global_bucket = TokenBucket(config.BROADCAST_GLOBAL_RATE, config.BROADCAST_GLOBAL_RATE)
+_chat_buckets: Dict[int, TokenBucket] = {}
+
+
+def _chat_bucket(chat_id: int) -> TokenBucket:
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_buckets[chat_id] = TokenBucket(config.BROADCAST_CHAT_RATE, 1)
+    return bucket
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    # В новых версиях python-telegram-bot retry_after — timedelta, в старых — число секунд
+    if isinstance(error.retry_after, timedelta):
+        return error.retry_after.total_seconds()
+    return float(error.retry_after)
+
+
+async def call_with_limits(chat_id: int, request: Callable[[], Awaitable]):
+    """
+    Выполняет запрос к Telegram для chat_id в пределах общего лимита и лимита чата.
+    На 429 (RetryAfter) ждет указанное время и повторяет, на таймаут — повторяет с паузой;
+    после BROADCAST_MAX_RETRIES повторов пробрасывает последнюю ошибку.
+    """
+    for attempt in range(config.BROADCAST_MAX_RETRIES + 1):
+        await _chat_bucket(chat_id).acquire()
+        await _global_bucket.acquire()
+        try:
+            return await request()
+        except RetryAfter as e:
+            if attempt == config.BROADCAST_MAX_RETRIES:
+                raise
+            delay = _retry_after_seconds(e)
+            logging.warning(f"Рассылка: Telegram просит подождать {delay:.0f} с (чат {chat_id}).")
+            _global_bucket.pause(delay)
+        except TimedOut:
+            if attempt == config.BROADCAST_MAX_RETRIES:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+
+class BroadcastResult(NamedTuple):
+    message_ids: Dict[int, int]  # user_id -> message_id доставленного сообщения
+    failed: List[int]
+
+
+async def run_broadcast(bot: Bot, sender_id: int, recipients: List[int],
+                        send: Callable[[int], Awaitable[Message]],
+                        on_sent: Optional[Callable[[int, Message], None]] = None) -> BroadcastResult:
+    """
+    Отправляет сообщение всем recipients параллельно (send(user_id) делает сам запрос).
+    Отправителю приходит одно сообщение с ходом рассылки, которое обновляется раз в
+    BROADCAST_PROGRESS_INTERVAL секунд. on_sent вызывается сразу после каждой доставки.
+    """
+    message_ids: Dict[int, int] = {}
+    failed: List[int] = []
+    slots = asyncio.Semaphore(config.BROADCAST_CONCURRENCY)
+
+    def progress_text() -> str:
+        return f"📤 Рассылка: отправлено {len(message_ids)} из {len(recipients)}, ошибок {len(failed)}"
+
+    async def send_one(user_id: int):
+        async with slots:
+            try:
+                message = await call_with_limits(user_id, lambda: send(user_id))
+            except Exception as e:
+                logging.error(f"Не удалось отправить рассылку пользователю {user_id}: {e}")
+                failed.append(user_id)
+                return
+        message_ids[user_id] = message.message_id
+        if on_sent:
+            on_sent(user_id, message)
+
+    progress_message = await call_with_limits(sender_id, lambda: bot.send_message(chat_id=sender_id,
+                                                                                  text=progress_text()))
+    sending = asyncio.gather(*(send_one(user_id) for user_id in recipients))
+    shown = progress_text()
+    while not sending.done():
+        await asyncio.wait([sending], timeout=config.BROADCAST_PROGRESS_INTERVAL)
+        if (text := progress_text()) != shown:
+            shown = text
+            try:
+                await call_with_limits(sender_id, lambda: progress_message.edit_text(text))
+            except Exception as e:
+                logging.error(f"Не удалось обновить ход рассылки у {sender_id}: {e}")
+    await sending
+    return BroadcastResult(message_ids, failed)
+
+
+class BroadcastState:
+    """
+    Состояние одной рассылки: кому и какое сообщение доставлено, кто ответил и как,
+    и одно сообщение-отчет у отправителя, которое редактируется по мере ответов.
+    Списки имен поддерживаются отсортированными вставкой, а не сортируются заново на каждый ответ.
+    """
+
+    def __init__(self, broadcast_id: int, sender_id: int, text: str, recipients: List[int]):
+        self.broadcast_id = broadcast_id
+        self.sender_id = sender_id
+        self.text = text
+        self.recipients: Set[int] = set(recipients)
+        self.message_ids: Dict[int, int] = {}
+        self.answered: Set[int] = set()
+        self.accepted_names: List[str] = []
+        self.skipped_names: List[str] = []
+        self.report_message: Optional[Message] = None
+        self._report_task: Optional[asyncio.Task] = None
+
+    def remember_message(self, user_id: int, message: Message):
+        self.message_ids[user_id] = message.message_id
+
+    def is_pending(self, user_id: int) -> bool:
+        return user_id in self.recipients and user_id not in self.answered
+
+    def record_reply(self, user_id: int, name: str, accepted: bool) -> bool:
+        """Учитывает ответ получателя. Возвращает False, если он не получатель или уже ответил."""
+        if not self.is_pending(user_id):
+            return False
+        self.answered.add(user_id)
+        insort(self.accepted_names if accepted else self.skipped_names, name)
+        return True
+
+    def report_text(self) -> str:
+        return (f"📢 Отчет:\n✅ Приняли ({len(self.accepted_names)}): {', '.join(self.accepted_names) or '-'}\n"
+                f"⏭ Пропустили ({len(self.skipped_names)}): {', '.join(self.skipped_names) or '-'}")
+
+
+# Последние BROADCAST_HISTORY рассылок по ID, от старых к новым
+_broadcasts: Dict[int, BroadcastState] = {}
+_broadcast_ids = itertools.count(1)
+
+
+def new_broadcast(sender_id: int, text: str, recipients: List[int]) -> BroadcastState:
+    state = BroadcastState(next(_broadcast_ids), sender_id, text, recipients)
+    _broadcasts[state.broadcast_id] = state
+    while len(_broadcasts) > config.BROADCAST_HISTORY:
+        del _broadcasts[next(iter(_broadcasts))]
+    return state
+
+
+def find_broadcast_for_reply(user_id: int, reply_to_message_id: Optional[int]) -> Optional[BroadcastState]:
+    """
+    Рассылка, на которую отвечает user_id: та, чье сообщение он процитировал,
+    а иначе самая свежая, на которую он еще не ответил.
+    """
+    if reply_to_message_id is not None:
+        for state in _broadcasts.values():
+            if state.message_ids.get(user_id) == reply_to_message_id:
+                return state if state.is_pending(user_id) else None
+    for state in reversed(_broadcasts.values()):
+        if state.is_pending(user_id):
+            return state
+    return None
+
+
+def schedule_report(bot: Bot, state: BroadcastState):
+    """
+    Обновляет отчет у отправителя не чаще раза в BROADCAST_REPORT_DEBOUNCE секунд:
+    ответы, пришедшие за это время, попадают в одно редактирование.
+    """
+    if state._report_task is None or state._report_task.done():
+        state._report_task = asyncio.create_task(_send_report(bot, state))
+
+
+async def _send_report(bot: Bot, state: BroadcastState):
+    # Ответы, пришедшие пока отчет отправляется, застают задачу еще живой и новую не создают,
+    # поэтому задача повторяет отправку, пока отчет у отправителя не совпадет с текущим.
+    while True:
+        await asyncio.sleep(config.BROADCAST_REPORT_DEBOUNCE)
+        text = state.report_text()
+        if state.report_message is not None and state.report_message.text == text:
+            return
+        try:
+            if state.report_message is None:
+                state.report_message = await call_with_limits(
+                    state.sender_id, lambda: bot.send_message(chat_id=state.sender_id, text=text))
+            else:
+                state.report_message = await call_with_limits(
+                    state.sender_id, lambda: state.report_message.edit_text(text))
+        except Exception as e:
+            # Следующий ответ получателя запланирует новую попытку
+            logging.error(f"Не удалось обновить отчет о рассылке {state.broadcast_id} у {state.sender_id}: {e}")
+            return
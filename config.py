@@ -11,14 +11,15 @@ load_dotenv()
 BOT_TOKEN: str = os.getenv("BOT_TOKEN")
 TESSERACT_CMD: str = os.getenv("TESSERACT_CMD")
 WEB_APP_URL: str = os.getenv("WEB_APP_URL") # URL для Web App
+WEB_APP_AUTH_MAX_AGE = 24 * 60 * 60  # Сколько секунд веб-сервер принимает подпись Telegram Web App (initData)
 ADMIN_USER_ID: int = 1181905320 # ID главного администратора
 
 # --- Пути ---
 BASE_DIR = Path(__file__).resolve().parent
 DATA_DIR = BASE_DIR / "data"
-TEMP_DIR = BASE_DIR / "temp"
 DB_PATH = DATA_DIR / "bot_data.db"
 GRAFIK_PATH = DATA_DIR / "grafik.json"
+EMPLOYEES_PATH = DATA_DIR / "employees.json"
 INFO_PHOTOS_DIR = DATA_DIR / "info_photos"
 
 # --- Google Sheets ---
@@ -57,4 +58,42 @@ RUS_MONTHS = [
     "Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
     "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"
 ]
-SHIFT_SYMBOLS = {"work": "🟢 Рабочий день", "closed": "🟡 Закрыто", "off": "🔴 Выходной"}
\ No newline at end of file
+SHIFT_SYMBOLS = {"work": "🟢 Рабочий день", "closed": "🟡 Закрыто", "off": "🔴 Выходной"}
+
+# --- Производительность ---
+DB_READER_CONNECTIONS = int(os.getenv("DB_READER_CONNECTIONS", "3"))  # Соединений на чтение в пуле БД
+SCAN_BATCH_MAX_ROWS = 100  # Максимум сканов в одной транзакции записи
+SCAN_BATCH_MAX_DELAY = 0.005  # Сколько секунд ждать попутные сканы перед коммитом
+GSHEET_FLUSH_INTERVAL = 3.0  # Как часто (сек) отправлять накопившиеся сканы в Google Sheets
+GSHEET_FLUSH_MAX_ROWS = 500  # Максимум строк в одной отправке в Google Sheets
+GSHEET_OUTBOX_MAX_ATTEMPTS = 20  # После скольких неудачных попыток скан снимается с отправки в Google Sheets
+GSHEET_CLIENT_MAX_AGE = 45 * 60  # Через сколько секунд клиент Google Sheets авторизуется заново в любом случае
+GSHEET_TOKEN_REFRESH_MARGIN = 5 * 60  # За сколько секунд до истечения токена авторизоваться заново
+GSHEET_CURSOR_TTL = 10 * 60  # Как часто (сек) сверять локальные курсоры строк с Google Sheets
+GSHEET_SNAPSHOT_TTL = float(os.getenv("GSHEET_SNAPSHOT_TTL", "60"))  # Сколько секунд отчеты берут таблицу из снимка
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 2)))  # Процессов распознавания фото
+OCR_QUEUE_LIMIT = int(os.getenv("OCR_QUEUE_LIMIT", "32"))  # Сколько фото может ждать распознавания одновременно
+OCR_TIMEOUT = 20.0  # Сколько секунд ждать распознавания одного фото
+OCR_TESSERACT_TIMEOUT = 8.0  # Сколько секунд дать одному запуску tesseract внутри рабочего процесса
+OCR_FAST_MAX_SIDE = 800  # До какой большей стороны (пикс.) уменьшать фото для быстрых этапов распознавания
+RECOGNITION_CACHE_SIZE = 2000  # Сколько результатов распознавания держать в памяти
+RECOGNITION_CACHE_DISK_SIZE = 50000  # Сколько результатов распознавания хранить в БД
+RECOGNITION_CACHE_TTL = 7 * 24 * 60 * 60  # Сколько секунд результат распознавания считается действительным
+RECOGNITION_CACHE_PRUNE_INTERVAL = 60 * 60  # Как часто (сек) удалять из БД устаревшие и лишние записи кэша
+BROADCAST_GLOBAL_RATE = 25  # Сообщений в секунду на всех (лимит Telegram — около 30)
+BROADCAST_CHAT_RATE = 1.0  # Сообщений в секунду в один чат
+BROADCAST_CONCURRENCY = 16  # Сколько запросов рассылки держать в полете одновременно
+BROADCAST_MAX_RETRIES = 3  # Сколько раз повторять отправку после 429 или таймаута
+BROADCAST_PROGRESS_INTERVAL = 2.0  # Как часто (сек) обновлять у отправителя ход рассылки
+BROADCAST_REPORT_DEBOUNCE = 3.0  # Сколько секунд копить ответы на рассылку перед обновлением отчета
+BROADCAST_HISTORY = 20  # Сколько последних рассылок помнить для учета ответов
+UPDATES_CONCURRENCY = int(os.getenv("UPDATES_CONCURRENCY", "32"))  # Сколько апдейтов Telegram обрабатывать одновременно
+UPDATES_CLASS_LIMITS = {  # Лимиты одновременных апдейтов по классам (классы определяет main.classify_update)
+    "ocr": OCR_WORKERS * 2,  # Фото на распознавание
+    "reports": 2,  # Отчеты за день и декаду (Google Sheets и тяжелые запросы к БД)
+    "broadcast": 2,  # Сообщения, запускающие рассылку
+}
+USER_REGISTRY_CHECK_INTERVAL = 5.0  # Как часто (сек) проверять, не изменился ли grafik.json
+STATS_CACHE_SIZE = 500  # Сколько пользователей держать в кэше страницы статистики веб-сервера
+STATS_SHELL_MAX_AGE = 300  # Сколько секунд браузер может не перепроверять оболочку страницы статистики
+WEB_GZIP_MIN_SIZE = 500  # Ответы веб-сервера от этого размера (байт) сжимаются gzip
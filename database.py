@@ -1,16 +1,57 @@
 # Файл: database.py (С УЧЕТОМ СИМУЛИРОВАННОГО ГОДА)
 
 import aiosqlite
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Tuple
 import calendar
+import time
 # Добавлен импорт SIMULATED_YEAR
-from config import DB_PATH, RUS_MONTHS, DECADE_NORM, PREMIUM_RATE, SIMULATED_YEAR
+from config import (DB_PATH, RUS_MONTHS, DECADE_NORM, PREMIUM_RATE, SIMULATED_YEAR, DB_READER_CONNECTIONS,
+                    SCAN_BATCH_MAX_ROWS, SCAN_BATCH_MAX_DELAY)
+from leaderboard import Leaderboard
 
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
 
+# --- Пул соединений ---
+# Одно соединение на запись (SQLite всё равно допускает только одного писателя)
+# и несколько соединений на чтение. Открываются один раз в init_db() и живут до close_db().
+WRITER_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+READER_PRAGMAS = (
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA mmap_size=67108864",
+    "PRAGMA query_only=ON",
+)
+
+DAY_BACKFILL_BATCH = 5000  # Сколько строк обновлять за одну транзакцию при миграции колонки day
+
+_writer: Optional[aiosqlite.Connection] = None
+_write_lock: Optional[asyncio.Lock] = None
+_readers: Optional[asyncio.Queue] = None
+_reader_conns: List[aiosqlite.Connection] = []
+
+# Очередь записи сканов: обработчики кладут сканы сюда, а фоновая задача
+# сбрасывает их пачками одной транзакцией (group commit).
+_scan_queue: Optional[asyncio.Queue] = None
+_scan_flusher: Optional[asyncio.Task] = None
+
+# Общий рейтинг в памяти. Его читает только веб-сервер: рейтинг строится из БД при первом запросе,
+# а дальше в нем пересчитываются лишь пользователи, чьи итоги изменились (по stats_version.seq).
+LEADERBOARD = Leaderboard()
+_leaderboard_seq: Optional[int] = None  # Версия статистики команды, до которой рейтинг учел изменения
+_leaderboard_lock: Optional[asyncio.Lock] = None
+
 
 def now_moscow():
     """
@@ -26,15 +67,82 @@ def now_moscow():
     return now
 
 
-async def init_db():
-    """Инициализирует базу данных, создавая таблицы, если их нет."""
-    async with aiosqlite.connect(DB_PATH) as db:
+async def _open_connection(db_path, pragmas) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(db_path)
+    for pragma in pragmas:
+        await conn.execute(pragma)
+    return conn
+
+
+async def open_pool(db_path=DB_PATH, readers: int = DB_READER_CONNECTIONS):
+    """Открывает соединение на запись и пул соединений на чтение."""
+    global _writer, _write_lock, _readers
+    if _writer is not None:
+        return
+    # Писатель открывается первым: он переводит базу в WAL, без которого читатели блокировали бы запись.
+    _writer = await _open_connection(db_path, WRITER_PRAGMAS)
+    _write_lock = asyncio.Lock()
+    _readers = asyncio.Queue()
+    for _ in range(max(1, readers)):
+        conn = await _open_connection(db_path, READER_PRAGMAS)
+        _reader_conns.append(conn)
+        _readers.put_nowait(conn)
+    logging.info(f"Пул соединений с БД открыт: 1 на запись, {len(_reader_conns)} на чтение.")
+
+
+async def close_db():
+    """Дописывает очередь сканов и закрывает все соединения пула. Вызывается при остановке бота и веб-сервера."""
+    global _writer, _write_lock, _readers, _scan_queue, _scan_flusher
+    if _scan_flusher is not None:
+        _scan_queue.put_nowait(None)  # Сигнал фоновой задаче: дописать то, что в очереди, и завершиться
+        await _scan_flusher
+        _scan_queue, _scan_flusher = None, None
+    for conn in _reader_conns:
+        await conn.close()
+    _reader_conns.clear()
+    if _writer is not None:
+        await _writer.close()
+    _writer, _write_lock, _readers = None, None, None
+    logging.info("Пул соединений с БД закрыт.")
+
+
+@asynccontextmanager
+async def writer() -> AsyncIterator[aiosqlite.Connection]:
+    """Выдает соединение на запись; всё, что выполнено внутри блока, коммитится одной транзакцией."""
+    if _writer is None:
+        raise RuntimeError("Пул соединений не открыт: сначала вызовите init_db().")
+    async with _write_lock:
+        try:
+            yield _writer
+            await _writer.commit()
+        except BaseException:
+            await _writer.rollback()
+            raise
+
+
+@asynccontextmanager
+async def reader() -> AsyncIterator[aiosqlite.Connection]:
+    """Берет свободное соединение на чтение из пула и возвращает его обратно после блока."""
+    if _readers is None:
+        raise RuntimeError("Пул соединений не открыт: сначала вызовите init_db().")
+    conn = await _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put_nowait(conn)
+
+
+async def init_db(db_path=DB_PATH):
+    """Открывает пул соединений и создает таблицы, если их нет."""
+    await open_pool(db_path)
+    async with writer() as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS scooter_log (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
                 scooter_number TEXT NOT NULL,
-                timestamp TEXT NOT NULL
+                timestamp TEXT NOT NULL,
+                day TEXT
             )
         """)
         await db.execute("""
@@ -51,118 +159,752 @@ async def init_db():
                 PRIMARY KEY (user_id, log_date)
             )
         """)
-        await db.commit()
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS sheets_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                scooter_number TEXT NOT NULL,
+                number_col INTEGER NOT NULL,
+                date_col INTEGER NOT NULL,
+                sheet_time TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                dead_at TEXT,
+                sheet_row INTEGER
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS recognition_cache (
+                file_unique_id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                scooter_number TEXT NOT NULL,
+                content_hash TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_recognition_cache_created ON recognition_cache (created_at)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_recognition_cache_content ON recognition_cache (content_hash)")
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS roster (
+                user_id INTEGER PRIMARY KEY,
+                first_name TEXT,
+                last_name TEXT,
+                full_name TEXT,
+                short_name TEXT,
+                role TEXT,
+                permissions TEXT
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS shifts (
+                day TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                shift_type TEXT NOT NULL,
+                PRIMARY KEY (day, user_id)
+            ) WITHOUT ROWID
+        """)
+        # Первичный ключ отвечает на "кто работает в этот день", индекс ниже — на окно смен одного пользователя
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_shifts_user_day ON shifts (user_id, day)")
+        await _add_day_column(db)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_scooter_log_user_day ON scooter_log (user_id, day)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_scooter_log_day_user ON scooter_log (day, user_id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_historic_stats_day_user ON historic_stats (log_date, user_id)")
+    await _backfill_day_column()
+    await _init_daily_totals()
+    _start_scan_flusher()
     logging.info("База данных успешно инициализирована.")
 
 
-async def add_scooter(user_id: int, scooter_number: str):
-    """Добавляет запись о самокате в базу данных."""
-    timestamp_str = now_moscow().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
+async def _add_day_column(db: aiosqlite.Connection):
+    """Добавляет в старую scooter_log колонку day (локальная дата скана, 'YYYY-MM-DD')."""
+    async with db.execute("PRAGMA table_info(scooter_log)") as cursor:
+        columns = {row[1] async for row in cursor}
+    if "day" not in columns:
+        await db.execute("ALTER TABLE scooter_log ADD COLUMN day TEXT")
+        logging.info("В scooter_log добавлена колонка day.")
+
+
+async def _backfill_day_column(batch_size: int = DAY_BACKFILL_BATCH):
+    """
+    Заполняет day для старых записей небольшими транзакциями,
+    чтобы запись новых сканов не ждала окончания миграции.
+    """
+    async with reader() as db:
+        async with db.execute("SELECT MIN(id), MAX(id) FROM scooter_log WHERE day IS NULL") as cursor:
+            min_id, max_id = await cursor.fetchone()
+    if min_id is None:
+        return
+
+    logging.info(f"Заполняю колонку day для записей scooter_log с id {min_id}..{max_id}...")
+    for start_id in range(min_id, max_id + 1, batch_size):
+        async with writer() as db:
+            # timestamp хранится в московском времени, поэтому первые 10 символов и есть нужная дата.
+            await db.execute(
+                "UPDATE scooter_log SET day = substr(timestamp, 1, 10) WHERE id >= ? AND id < ? AND day IS NULL",
+                (start_id, start_id + batch_size)
+            )
+    logging.info("Колонка day заполнена.")
+
+
+# Пересчитывает строку daily_totals за один день пользователя: живые сканы + значение из historic_stats.
+_RECALC_DAILY_TOTAL_SQL = """
+    INSERT INTO daily_totals (user_id, day, count, distinct_count, first_ts, last_ts)
+    VALUES (
+        {user_id}, {day},
+        {historic} + (SELECT COUNT(*) FROM scooter_log WHERE user_id = {user_id} AND day = {day}),
+        {historic} + (SELECT COUNT(DISTINCT scooter_number) FROM scooter_log WHERE user_id = {user_id} AND day = {day}),
+        (SELECT MIN(timestamp) FROM scooter_log WHERE user_id = {user_id} AND day = {day}),
+        (SELECT MAX(timestamp) FROM scooter_log WHERE user_id = {user_id} AND day = {day})
+    )
+    ON CONFLICT (user_id, day) DO UPDATE SET
+        count = excluded.count,
+        distinct_count = excluded.distinct_count,
+        first_ts = excluded.first_ts,
+        last_ts = excluded.last_ts;
+    DELETE FROM daily_totals WHERE user_id = {user_id} AND day = {day} AND count = 0;
+"""
+_HISTORIC_COUNT_SQL = "IFNULL((SELECT count FROM historic_stats WHERE user_id = {user_id} AND log_date = {day}), 0)"
+
+
+def _recalc_daily_total(user_id: str, day: str, historic: Optional[str] = None) -> str:
+    historic = historic or _HISTORIC_COUNT_SQL.format(user_id=user_id, day=day)
+    return _RECALC_DAILY_TOTAL_SQL.format(user_id=user_id, day=day, historic=historic)
+
+
+# Триггеры обновляют сводку в той же транзакции, что и запись скана или истории.
+# Так сводка остается верной и при записи из add_history.py / migrate_data.py, которые работают в обход этого модуля.
+# INSERT OR REPLACE в historic_stats не вызывает триггер удаления, поэтому исторические триггеры
+# не прибавляют разницу, а пересчитывают день целиком.
+# Колонка day появилась позже и может быть не заполнена у тех, кто пишет в scooter_log напрямую (migrate_data.py,
+# ручные правки, старая версия бота): тогда день берется из timestamp, и тот же день дописывается в саму строку.
+_SCAN_DAY_SQL = "COALESCE(NEW.day, substr(NEW.timestamp, 1, 10))"
+DAILY_TOTALS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_scooter_log_fill_day AFTER INSERT ON scooter_log WHEN NEW.day IS NULL
+    BEGIN
+        UPDATE scooter_log SET day = substr(NEW.timestamp, 1, 10) WHERE id = NEW.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_scooter_log_daily_insert AFTER INSERT ON scooter_log
+    BEGIN
+        INSERT INTO daily_totals (user_id, day, count, distinct_count, first_ts, last_ts)
+        VALUES (NEW.user_id, {_SCAN_DAY_SQL}, 1, 1, NEW.timestamp, NEW.timestamp)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            count = count + 1,
+            distinct_count = distinct_count + NOT EXISTS (
+                SELECT 1 FROM scooter_log
+                WHERE user_id = NEW.user_id AND day = {_SCAN_DAY_SQL} AND scooter_number = NEW.scooter_number
+                    AND id <> NEW.id
+            ),
+            first_ts = min(IFNULL(first_ts, NEW.timestamp), NEW.timestamp),
+            last_ts = max(IFNULL(last_ts, NEW.timestamp), NEW.timestamp);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_scooter_log_daily_delete AFTER DELETE ON scooter_log
+    BEGIN
+        {_recalc_daily_total("OLD.user_id", "OLD.day")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_historic_stats_daily_insert AFTER INSERT ON historic_stats
+    BEGIN
+        {_recalc_daily_total("NEW.user_id", "NEW.log_date", historic="NEW.count")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_historic_stats_daily_update AFTER UPDATE ON historic_stats
+    BEGIN
+        {_recalc_daily_total("OLD.user_id", "OLD.log_date")}
+        {_recalc_daily_total("NEW.user_id", "NEW.log_date", historic="NEW.count")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_historic_stats_daily_delete AFTER DELETE ON historic_stats
+    BEGIN
+        {_recalc_daily_total("OLD.user_id", "OLD.log_date", historic="0")}
+    END
+    """,
+)
+
+
+# Версия статистики пользователя растет при каждом изменении его строк в daily_totals, то есть при новом скане,
+# удалении или импорте истории. Строка с user_id = 0 — версия статистики всей команды.
+# В seq строки пользователя записывается версия команды на момент его последнего изменения:
+# по ней видно, чьи итоги поменялись после известной версии команды.
+# Версии лежат в базе, поэтому кэши веб-сервера видят и записи бота, и add_history.py.
+TEAM_STATS_VERSION_ID = 0
+_BUMP_STATS_VERSION_SQL = """
+    INSERT INTO stats_version (user_id, version, seq) VALUES ({team_id}, 1, 1)
+    ON CONFLICT (user_id) DO UPDATE SET version = version + 1, seq = seq + 1;
+    INSERT INTO stats_version (user_id, version, seq)
+    VALUES ({user_id}, 1, (SELECT version FROM stats_version WHERE user_id = {team_id}))
+    ON CONFLICT (user_id) DO UPDATE SET version = version + 1, seq = excluded.seq;
+"""
+
+
+def _bump_stats_version(user_id: str) -> str:
+    return _BUMP_STATS_VERSION_SQL.format(user_id=user_id, team_id=TEAM_STATS_VERSION_ID)
+
+
+STATS_VERSION_TRIGGERS = (
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_daily_totals_version_insert AFTER INSERT ON daily_totals
+    BEGIN
+        {_bump_stats_version("NEW.user_id")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_daily_totals_version_update AFTER UPDATE ON daily_totals
+    BEGIN
+        {_bump_stats_version("NEW.user_id")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_daily_totals_version_delete AFTER DELETE ON daily_totals
+    BEGIN
+        {_bump_stats_version("OLD.user_id")}
+    END
+    """,
+)
+
+
+async def _init_daily_totals():
+    """
+    Создает сводку daily_totals (итоги по пользователю за день) и триггеры, которые ее поддерживают.
+    При первом запуске на существующей базе заполняет сводку из scooter_log и historic_stats.
+    """
+    async with writer() as db:
+        # Модуль sqlite3 выполняет CREATE TABLE вне транзакции, поэтому открываем ее явно: иначе при сбое
+        # заполнения таблица осталась бы пустой, а следующий запуск счел бы ее готовой и пропустил заполнение.
+        await db.execute("BEGIN IMMEDIATE")
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_totals'") as cursor:
+            exists = await cursor.fetchone() is not None
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS daily_totals (
+                user_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                distinct_count INTEGER NOT NULL,
+                first_ts TEXT,
+                last_ts TEXT,
+                PRIMARY KEY (user_id, day)
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_daily_totals_day_user ON daily_totals (day, user_id)")
+        if not exists:
+            logging.info("Заполняю сводку daily_totals из scooter_log и historic_stats...")
+            await db.execute("""
+                INSERT INTO daily_totals (user_id, day, count, distinct_count, first_ts, last_ts)
+                SELECT user_id, day, COUNT(*), COUNT(DISTINCT scooter_number), MIN(timestamp), MAX(timestamp)
+                FROM scooter_log GROUP BY user_id, day
+            """)
+            await db.execute("""
+                INSERT INTO daily_totals (user_id, day, count, distinct_count)
+                SELECT user_id, log_date, count, count FROM historic_stats WHERE true
+                ON CONFLICT (user_id, day) DO UPDATE SET
+                    count = count + excluded.count,
+                    distinct_count = distinct_count + excluded.distinct_count
+            """)
+        # Триггеры создаются в той же транзакции, что и заполнение, чтобы ни один скан не потерялся между ними.
+        for trigger_sql in DAILY_TOTALS_TRIGGERS:
+            await db.execute(trigger_sql)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS stats_version (
+                user_id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL,
+                seq INTEGER NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_stats_version_seq ON stats_version (seq)")
+        for trigger_sql in STATS_VERSION_TRIGGERS:
+            await db.execute(trigger_sql)
+
+
+async def _sync_leaderboard():
+    """
+    Догоняет рейтинг до текущей версии статистики команды. При первом вызове строит его по daily_totals целиком,
+    дальше пересчитывает итоги только тех пользователей, у кого версия изменилась. Одновременные запросы
+    ждут одну сверку, а не перестраивают рейтинг наперегонки.
+    """
+    global _leaderboard_seq, _leaderboard_lock
+    if _leaderboard_seq is not None and await get_stats_version(TEAM_STATS_VERSION_ID) == _leaderboard_seq:
+        return
+    if _leaderboard_lock is None:
+        _leaderboard_lock = asyncio.Lock()
+    async with _leaderboard_lock:
+        async with reader() as db:
+            # Версия читается раньше итогов: изменение между двумя запросами попадет в следующую сверку,
+            # а итоги пересчитываются целиком, так что повторный пересчет ничего не испортит.
+            async with db.execute("SELECT version FROM stats_version WHERE user_id = ?",
+                                  (TEAM_STATS_VERSION_ID,)) as cursor:
+                row = await cursor.fetchone()
+                seq = row[0] if row else 0
+            if seq == _leaderboard_seq:
+                return
+            if _leaderboard_seq is None:
+                async with db.execute("SELECT user_id, SUM(count) FROM daily_totals GROUP BY user_id") as cursor:
+                    LEADERBOARD.rebuild({row[0]: row[1] async for row in cursor})
+            else:
+                async with db.execute(
+                    "SELECT user_id FROM stats_version WHERE seq > ? AND user_id != ?",
+                    (_leaderboard_seq, TEAM_STATS_VERSION_ID)
+                ) as cursor:
+                    changed = [row[0] async for row in cursor]
+                for user_id in changed:
+                    async with db.execute("SELECT SUM(count) FROM daily_totals WHERE user_id = ?",
+                                          (user_id,)) as cursor:
+                        total = (await cursor.fetchone())[0]
+                    if total is None:
+                        LEADERBOARD.remove(user_id)
+                    else:
+                        LEADERBOARD.set_total(user_id, total)
+            _leaderboard_seq = seq
+
+
+async def get_leaderboard_top(n: int = 10) -> List[Tuple[int, int]]:
+    """Первые n мест общего рейтинга: список (user_id, итог)."""
+    await _sync_leaderboard()
+    return LEADERBOARD.top(n)
+
+
+async def get_user_rank(user_id: int):
+    """Место пользователя в общем рейтинге или "N/A", если сканов у него нет."""
+    await _sync_leaderboard()
+    return LEADERBOARD.rank(user_id) or "N/A"
+
+
+async def get_stats_version(user_id: int) -> int:
+    """Текущая версия статистики пользователя (TEAM_STATS_VERSION_ID — всей команды); 0, если изменений не было."""
+    async with reader() as db:
+        async with db.execute("SELECT version FROM stats_version WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+
+
+def _start_scan_flusher():
+    global _scan_queue, _scan_flusher
+    if _scan_flusher is None:
+        _scan_queue = asyncio.Queue()
+        _scan_flusher = asyncio.create_task(_flush_scans_forever())
+
+
+async def _flush_scans_forever():
+    """Собирает сканы из очереди в пачки: до SCAN_BATCH_MAX_ROWS строк или SCAN_BATCH_MAX_DELAY секунд."""
+    while True:
+        batch = [await _scan_queue.get()]
+        await asyncio.sleep(0)  # Пропускаем вперед обработчики, проснувшиеся в том же цикле событий
+        if batch[0] is not None and 0 < _scan_queue.qsize() < SCAN_BATCH_MAX_ROWS:
+            # Идет поток сканов: даем остальным несколько миллисекунд, чтобы попасть в ту же транзакцию.
+            # Одиночный скан записывается сразу, без ожидания.
+            await asyncio.sleep(SCAN_BATCH_MAX_DELAY)
+        while len(batch) < SCAN_BATCH_MAX_ROWS and not _scan_queue.empty():
+            batch.append(_scan_queue.get_nowait())
+
+        stop = None in batch
+        await _write_scan_batch([item for item in batch if item is not None])
+        if stop:
+            # После сигнала остановки в очереди могли остаться сканы из следующей пачки.
+            remaining = []
+            while not _scan_queue.empty():
+                if (item := _scan_queue.get_nowait()) is not None:
+                    remaining.append(item)
+            await _write_scan_batch(remaining)
+            return
+
+
+class PendingScan(NamedTuple):
+    user_id: int
+    scooter_number: str
+    timestamp: str
+    sheet_cols: Optional[Tuple[int, int]]
+    future: asyncio.Future
+
+
+async def _write_scan_batch(batch: List[PendingScan]):
+    """
+    Записывает пачку сканов, активность их авторов и строки для Google Sheets одной транзакцией
+    и будит ждущих.
+    """
+    if not batch:
+        return
+    scan_rows = [(scan.user_id, scan.scooter_number, scan.timestamp, scan.timestamp[:10]) for scan in batch]
+    last_seen = {scan.user_id: scan.timestamp[:10] for scan in batch}
+    outbox_rows = [
+        (scan.user_id, scan.scooter_number, scan.sheet_cols[0], scan.sheet_cols[1],
+         datetime.fromisoformat(scan.timestamp).strftime("%d.%m. %H:%M"), scan.timestamp)
+        for scan in batch if scan.sheet_cols
+    ]
+    try:
+        async with writer() as db:
+            await db.executemany(
+                "INSERT INTO scooter_log (user_id, scooter_number, timestamp, day) VALUES (?, ?, ?, ?)",
+                scan_rows
+            )
+            await db.executemany(
+                "INSERT OR REPLACE INTO activity (user_id, last_seen_date) VALUES (?, ?)",
+                list(last_seen.items())
+            )
+            await db.executemany(
+                """
+                INSERT INTO sheets_outbox (user_id, scooter_number, number_col, date_col, sheet_time, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                outbox_rows
+            )
+    except Exception as e:
+        logging.error(f"Не удалось записать пачку из {len(batch)} сканов: {e}")
+        for scan in batch:
+            if not scan.future.done():
+                scan.future.set_exception(e)
+        return
+
+    for scan in batch:
+        if not scan.future.done():
+            scan.future.set_result(None)
+
+
+def submit_scan(user_id: int, scooter_number: str, sheet_cols: Optional[Tuple[int, int]] = None) -> asyncio.Future:
+    """
+    Ставит скан в очередь записи. Возвращает future, который завершится после коммита пачки
+    с этим сканом (или с ошибкой, если запись не удалась).
+    Если переданы sheet_cols (колонки номера и даты), в той же транзакции скан попадает
+    в очередь на отправку в Google Sheets (таблица sheets_outbox).
+    """
+    if _scan_queue is None:
+        raise RuntimeError("Очередь записи не запущена: сначала вызовите init_db().")
+    future = asyncio.get_running_loop().create_future()
+    _scan_queue.put_nowait(PendingScan(user_id, scooter_number, now_moscow().isoformat(),
+                                       tuple(sheet_cols) if sheet_cols else None, future))
+    return future
+
+
+async def add_scooter(user_id: int, scooter_number: str, sheet_cols: Optional[Tuple[int, int]] = None):
+    """
+    Добавляет запись о самокате и обновляет дату активности пользователя. Возвращается после коммита.
+    sheet_cols — колонки пользователя в Google Sheets, куда скан потом допишет фоновая отправка.
+    """
+    await submit_scan(user_id, scooter_number, sheet_cols)
+
+
+async def fetch_sheets_outbox(limit: int) -> List[Tuple[int, int, str, int, int, str, Optional[int]]]:
+    """
+    Возвращает до limit строк, ожидающих отправки в Google Sheets, в порядке сканирования:
+    (id, user_id, номер, колонка номера, колонка даты, время для таблицы, закрепленная строка листа или None).
+    """
+    async with reader() as db:
+        cursor = await db.execute(
+            """
+            SELECT id, user_id, scooter_number, number_col, date_col, sheet_time, sheet_row
+            FROM sheets_outbox WHERE next_attempt_at <= ? AND dead_at IS NULL ORDER BY id LIMIT ?
+            """,
+            (time.time(), limit)
+        )
+        return await cursor.fetchall()
+
+
+async def get_sheets_outbox_reserved_rows() -> Dict[Tuple[int, int], int]:
+    """Последняя закрепленная за неотправленными строками строка листа по парам колонок (номер, дата)."""
+    async with reader() as db:
+        async with db.execute(
+            """
+            SELECT number_col, date_col, MAX(sheet_row) FROM sheets_outbox
+            WHERE sheet_row IS NOT NULL GROUP BY number_col, date_col
+            """
+        ) as cursor:
+            return {(row[0], row[1]): row[2] async for row in cursor}
+
+
+async def reserve_sheets_outbox_rows(rows: List[Tuple[int, int]]):
+    """Закрепляет за строками очереди строки листа: (id, строка листа). Вызывается до записи в таблицу."""
+    async with writer() as db:
+        await db.executemany("UPDATE sheets_outbox SET sheet_row = ? WHERE id = ?",
+                             [(sheet_row, row_id) for row_id, sheet_row in rows])
+
+
+async def ack_sheets_outbox(ids: List[int]):
+    """Удаляет строки, успешно записанные в Google Sheets."""
+    async with writer() as db:
+        await db.executemany("DELETE FROM sheets_outbox WHERE id = ?", [(row_id,) for row_id in ids])
+
+
+async def retry_sheets_outbox(ids: List[int], error: str, max_attempts: int) -> List[Tuple[int, int, str, int, int]]:
+    """
+    Откладывает строки после неудачной отправки: пауза растет с каждой попыткой, но не больше 5 минут.
+    Строки, исчерпавшие max_attempts попыток, больше не отправляются (dead_at) и возвращаются
+    списком (id, user_id, номер, колонка номера, колонка даты), чтобы о них можно было сообщить.
+    """
+    async with writer() as db:
+        await db.executemany(
+            """
+            UPDATE sheets_outbox
+            SET attempts = attempts + 1,
+                last_error = ?,
+                next_attempt_at = ? + min(300, 5 * (1 << min(attempts, 6)))
+            WHERE id = ?
+            """,
+            [(error, time.time(), row_id) for row_id in ids]
+        )
+        placeholders = ", ".join("?" * len(ids))
+        cursor = await db.execute(
+            f"""
+            SELECT id, user_id, scooter_number, number_col, date_col FROM sheets_outbox
+            WHERE id IN ({placeholders}) AND attempts >= ? AND dead_at IS NULL
+            """,
+            (*ids, max_attempts)
+        )
+        dead = await cursor.fetchall()
+        await db.executemany("UPDATE sheets_outbox SET dead_at = ? WHERE id = ?",
+                             [(now_moscow().isoformat(), row[0]) for row in dead])
+        return dead
+
+
+async def get_cached_recognition(file_unique_id: str, min_created_at: float) -> Optional[Tuple[str, int, Optional[str], float]]:
+    """Результат распознавания фото из кэша на диске: (номер, user_id, хэш содержимого, время записи) или None."""
+    async with reader() as db:
+        async with db.execute(
+            """
+            SELECT scooter_number, user_id, content_hash, created_at FROM recognition_cache
+            WHERE file_unique_id = ? AND created_at >= ?
+            """,
+            (file_unique_id, min_created_at)
+        ) as cursor:
+            return await cursor.fetchone()
+
+
+async def get_cached_recognition_by_content(content_hash: str, min_created_at: float) -> Optional[str]:
+    """Номер, распознанный на файле с точно таким же содержимым, или None."""
+    async with reader() as db:
+        async with db.execute(
+            """
+            SELECT scooter_number FROM recognition_cache
+            WHERE content_hash = ? AND created_at >= ? ORDER BY created_at DESC LIMIT 1
+            """,
+            (content_hash, min_created_at)
+        ) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+
+async def load_recognition_cache(min_created_at: float, limit: int) -> List[Tuple[str, str, int, Optional[str], float]]:
+    """Последние limit записей кэша распознавания не старше min_created_at, от старых к новым."""
+    async with reader() as db:
+        cursor = await db.execute(
+            """
+            SELECT file_unique_id, scooter_number, user_id, content_hash, created_at FROM (
+                SELECT * FROM recognition_cache WHERE created_at >= ? ORDER BY created_at DESC LIMIT ?
+            ) ORDER BY created_at
+            """,
+            (min_created_at, limit)
+        )
+        return await cursor.fetchall()
+
+
+async def save_recognition_result(file_unique_id: str, user_id: int, scooter_number: str,
+                                  content_hash: Optional[str], created_at: float):
+    """Сохраняет успешно распознанный номер для фото (content_hash — хэш байтов файла)."""
+    async with writer() as db:
         await db.execute(
-            "INSERT INTO scooter_log (user_id, scooter_number, timestamp) VALUES (?, ?, ?)",
-            (user_id, scooter_number, timestamp_str)
+            """
+            INSERT OR REPLACE INTO recognition_cache (file_unique_id, user_id, scooter_number, content_hash, created_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (file_unique_id, user_id, scooter_number, content_hash, created_at)
+        )
+
+
+async def prune_recognition_cache(min_created_at: float, keep: int) -> int:
+    """Удаляет из кэша распознавания записи старше min_created_at и все, кроме keep самых новых."""
+    async with writer() as db:
+        cursor = await db.execute(
+            """
+            DELETE FROM recognition_cache WHERE created_at < ? OR file_unique_id NOT IN (
+                SELECT file_unique_id FROM recognition_cache ORDER BY created_at DESC LIMIT ?
+            )
+            """,
+            (min_created_at, keep)
+        )
+        return cursor.rowcount
+
+
+async def import_roster(rows: List[Tuple[int, str, str, str, str]]):
+    """Добавляет или обновляет сотрудников из grafik.json: (user_id, полное имя, короткое имя, роль, права)."""
+    async with writer() as db:
+        await db.executemany(
+            """
+            INSERT INTO roster (user_id, full_name, short_name, role, permissions) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                full_name = excluded.full_name,
+                short_name = excluded.short_name,
+                role = excluded.role,
+                permissions = excluded.permissions
+            """,
+            rows
         )
-        await db.commit()
+
+
+async def import_employee_names(rows: List[Tuple[int, str, str]]):
+    """Добавляет или обновляет имена сотрудников из employees.json: (user_id, имя, фамилия)."""
+    async with writer() as db:
+        await db.executemany(
+            """
+            INSERT INTO roster (user_id, first_name, last_name) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET first_name = excluded.first_name, last_name = excluded.last_name
+            """,
+            rows
+        )
+
+
+async def import_shifts(rows: List[Tuple[str, int, str]], user_ids: Iterable[int]):
+    """
+    Заменяет график смен импортом из grafik.json: rows — (день 'YYYY-MM-DD', user_id, тип смены), user_ids — все
+    сотрудники файла. У сотрудника файла удаляются смены, которых нет в rows, в пределах его дней из файла
+    (с первого по последний), поэтому прошедшие смены можно убирать из grafik.json. У тех, кого в файле нет
+    или у кого в файле нет ни одной смены, удаляются все смены. Все в одной транзакции.
+    """
+    imported = {(day, user_id) for day, user_id, _ in rows}
+    day_ranges: Dict[int, Tuple[str, str]] = {}
+    for day, user_id, _ in rows:
+        first, last = day_ranges.get(user_id, (day, day))
+        day_ranges[user_id] = (min(first, day), max(last, day))
+    user_ids = set(user_ids)
+
+    def is_stale(day: str, user_id: int) -> bool:
+        if (day, user_id) in imported:
+            return False
+        if user_id not in user_ids or user_id not in day_ranges:
+            return True
+        first, last = day_ranges[user_id]
+        return first <= day <= last
+
+    async with writer() as db:
+        # SELECT сам транзакцию не открывает: открываем явно, чтобы чтение и удаление видели одни и те же смены
+        await db.execute("BEGIN IMMEDIATE")
+        async with db.execute("SELECT day, user_id FROM shifts") as cursor:
+            stale = [(day, user_id) async for day, user_id in cursor if is_stale(day, user_id)]
+        await db.executemany("DELETE FROM shifts WHERE day = ? AND user_id = ?", stale)
+        await db.executemany("INSERT OR REPLACE INTO shifts (day, user_id, shift_type) VALUES (?, ?, ?)", rows)
+
+
+async def get_user_shifts(user_id: int, start_day: str, end_day: str) -> Optional[Dict[str, str]]:
+    """
+    Смены пользователя с start_day по end_day включительно: {день: тип смены}.
+    None, если у пользователя вообще нет ни одной смены в базе.
+    """
+    async with reader() as db:
+        async with db.execute(
+            "SELECT day, shift_type FROM shifts WHERE user_id = ? AND day BETWEEN ? AND ?",
+            (user_id, start_day, end_day)
+        ) as cursor:
+            shifts = {row[0]: row[1] async for row in cursor}
+        if shifts:
+            return shifts
+        async with db.execute("SELECT 1 FROM shifts WHERE user_id = ? LIMIT 1", (user_id,)) as cursor:
+            return {} if await cursor.fetchone() else None
+
+
+async def get_day_staff(day: str, shift_type: Optional[str] = "work") -> List[Tuple[int, str, str]]:
+    """
+    Кто стоит в графике на день: список (user_id, короткое имя, тип смены).
+    shift_type=None — все записи дня, включая выходные.
+    """
+    async with reader() as db:
+        cursor = await db.execute(
+            """
+            SELECT s.user_id, IFNULL(r.short_name, 'ID ' || s.user_id), s.shift_type
+            FROM shifts s LEFT JOIN roster r ON r.user_id = s.user_id
+            WHERE s.day = ? AND (? IS NULL OR s.shift_type = ?)
+            ORDER BY 2
+            """,
+            (day, shift_type, shift_type)
+        )
+        return await cursor.fetchall()
 
 
 async def update_last_activity(user_id: int):
     """Обновляет дату последней активности пользователя."""
     today_str = now_moscow().strftime("%Y-%m-%d")
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with writer() as db:
         await db.execute(
             "INSERT OR REPLACE INTO activity (user_id, last_seen_date) VALUES (?, ?)",
             (user_id, today_str)
         )
-        await db.commit()
 
 
 async def get_last_activity(user_id: int) -> Optional[str]:
     """Получает дату последней активности пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with reader() as db:
         async with db.execute("SELECT last_seen_date FROM activity WHERE user_id = ?", (user_id,)) as cursor:
             row = await cursor.fetchone()
             return row[0] if row else None
 
 
-async def get_personal_stats(user_id: int) -> Dict:
-    """Собирает всю статистику для одного пользователя из БД."""
+async def get_user_stats(user_id: int) -> Dict:
+    """
+    Вся статистика пользователя для страницы и бота за два запроса на одном соединении чтения:
+    все его дни из сводки daily_totals и сегодняшние сканы по часам. Оба запроса ставятся в очередь
+    соединения сразу, а поля (сегодня, декада, лучший день, среднее, графики) считаются из их результата.
+    Место в рейтинге сюда не входит: оно зависит от чужих сканов (см. get_user_rank).
+    """
     now = now_moscow()
-    today_start_str = now.strftime("%Y-%m-%d")
+    today_str = now.strftime("%Y-%m-%d")
     decade_start_str = now.replace(day=(1 if now.day <= 10 else 11 if now.day <= 20 else 21)).strftime("%Y-%m-%d")
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        # 1. Статистика за сегодня
-        cursor = await db.execute(
-            "SELECT scooter_number, timestamp FROM scooter_log WHERE user_id = ? AND date(timestamp) = ?",
-            (user_id, today_start_str)
+    week_days = [now - timedelta(days=i) for i in range(6, -1, -1)]
+
+    async with reader() as db:
+        daily_rows, hourly_rows = await asyncio.gather(
+            db.execute_fetchall(
+                "SELECT day, count, distinct_count, first_ts, last_ts FROM daily_totals WHERE user_id = ?",
+                (user_id,)
+            ),
+            db.execute_fetchall(
+                """
+                SELECT substr(timestamp, 12, 2) AS hour, COUNT(*) FROM scooter_log
+                WHERE user_id = ? AND day = ? GROUP BY hour
+                """,
+                (user_id, today_str)
+            ),
         )
-        today_rows = await cursor.fetchall()
-        today_numbers = [row[0] for row in today_rows]
 
-        # 2. Общая статистика и ранг
-        all_users_totals = {}
-        historic_totals_cursor = await db.execute("SELECT user_id, SUM(count) FROM historic_stats GROUP BY user_id")
-        async for row in historic_totals_cursor: all_users_totals[row[0]] = row[1]
-        live_totals_cursor = await db.execute("SELECT user_id, COUNT(*) FROM scooter_log GROUP BY user_id")
-        async for row in live_totals_cursor: all_users_totals[row[0]] = all_users_totals.get(row[0], 0) + row[1]
+    days = {row[0]: row[1:] for row in daily_rows}
+    overall_total = sum(row[1] for row in daily_rows)
+    today_count, today_distinct, first_ts, last_ts = days.get(today_str, (0, 0, None, None))
 
-        overall_total = all_users_totals.get(user_id, 0)
-        sorted_ranks = sorted(all_users_totals.items(), key=lambda item: item[1], reverse=True)
-        rank = next((i + 1 for i, (uid, total) in enumerate(sorted_ranks) if uid == user_id), "N/A")
+    best_day_count, best_day_date = 0, "нет данных"
+    if daily_rows:
+        best_day, best_count = max(((row[0], row[1]) for row in daily_rows), key=lambda item: (item[1], item[0]))
+        if best_count > 0:
+            best_day_count, best_day_date = best_count, datetime.strptime(best_day, "%Y-%m-%d").strftime("%d.%m")
 
-        # 3. Статистика за текущую декаду
-        cursor = await db.execute(
-            """
-            SELECT
-                (SELECT IFNULL(SUM(count), 0) FROM historic_stats WHERE user_id = ? AND log_date >= ?) +
-                (SELECT IFNULL(COUNT(*), 0) FROM scooter_log WHERE user_id = ? AND date(timestamp) >= ?)
-            """,
-            (user_id, decade_start_str, user_id, decade_start_str)
-        )
-        decade_total = (await cursor.fetchone())[0]
-
-        # 4. Лучший день
-        best_historic_day_cursor = await db.execute(
-            "SELECT log_date, count FROM historic_stats WHERE user_id = ? ORDER BY count DESC, log_date DESC LIMIT 1",
-            (user_id,))
-        best_historic_day = await best_historic_day_cursor.fetchone()
-        best_live_day_cursor = await db.execute(
-            "SELECT date(timestamp), COUNT(*) as c FROM scooter_log WHERE user_id = ? GROUP BY date(timestamp) ORDER BY c DESC LIMIT 1",
-            (user_id,))
-        best_live_day = await best_live_day_cursor.fetchone()
-
-        best_day_count, best_day_date = 0, "нет данных"
-        if best_historic_day and best_historic_day[1] > best_day_count:
-            best_day_count, best_day_date = best_historic_day[1], datetime.strptime(str(best_historic_day[0]),
-                                                                                    "%Y-%m-%d").strftime("%d.%m")
-        if best_live_day and best_live_day[1] > best_day_count:
-            best_day_count, best_day_date = best_live_day[1], datetime.strptime(str(best_live_day[0]),
-                                                                                "%Y-%m-%d").strftime("%d.%m")
-
-        # 5. Среднее в день
-        active_days_cursor = await db.execute(
-            "SELECT COUNT(*) FROM (SELECT DISTINCT log_date FROM historic_stats WHERE user_id = ? UNION SELECT DISTINCT date(timestamp) FROM scooter_log WHERE user_id = ?)",
-            (user_id, user_id)
-        )
-        total_active_days = (await active_days_cursor.fetchone())[0]
-        average_per_day = overall_total // total_active_days if total_active_days > 0 else 0
+    hourly_values = [0] * 24
+    for hour, count in hourly_rows:
+        hourly_values[int(hour)] = count
 
-    last_addition_str = "нет данных"
-    if today_rows:
-        latest_timestamp_str = max([row[1] for row in today_rows])
-        last_addition_str = datetime.fromisoformat(latest_timestamp_str).strftime("%H:%M")
+    # Средний интервал между сканами считается только по живым сканам: у истории нет времени
+    live_today = sum(hourly_values)
+    avg_time_today = "N/A"
+    if live_today > 1 and first_ts and last_ts:
+        seconds = int((datetime.fromisoformat(last_ts) - datetime.fromisoformat(first_ts)).total_seconds()
+                      / (live_today - 1))
+        avg_time_today = f"{seconds // 60} мин {seconds % 60:02d} с"
 
     return {
-        "today_count": len(today_numbers),
-        "today_duplicates": len(today_numbers) - len(set(today_numbers)),
-        "last_addition": last_addition_str,
-        "decade_total": decade_total,
+        "today_count": today_count,
+        "today_duplicates": today_count - today_distinct,
+        "last_addition": datetime.fromisoformat(last_ts).strftime("%H:%M") if last_ts else "нет данных",
+        "avg_time_today": avg_time_today,
+        "decade_total": sum(row[1] for row in daily_rows if row[0] >= decade_start_str),
         "overall_total": overall_total,
         "best_day_count": best_day_count,
         "best_day_date": best_day_date,
-        "average_per_day": average_per_day,
-        "rank": rank,
+        "average_per_day": overall_total // len(daily_rows) if daily_rows else 0,
+        "hourly_labels": [f"{h:02d}" for h in range(24)],
+        "hourly_data": hourly_values,
+        "weekly_labels": [d.strftime("%d.%m") for d in week_days],
+        "weekly_data": [days.get(d.strftime("%Y-%m-%d"), (0,))[0] for d in week_days],
     }
 
 
@@ -173,34 +915,14 @@ async def get_report_stats(period: str, decade_num: Optional[int] = None) -> Dic
     if period == "today":
         today_str = now.strftime("%Y-%m-%d")
         results = {}
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with reader() as db:
             cursor = await db.execute(
-                """
-                SELECT
-                    user_id,
-                    COUNT(*),
-                    MAX(timestamp)
-                FROM scooter_log
-                WHERE date(timestamp) = ?
-                GROUP BY user_id
-                """,
+                "SELECT user_id, count, count - distinct_count, last_ts FROM daily_totals WHERE day = ? AND count > 0",
                 (today_str,)
             )
             async for row in cursor:
-                user_id, count, last_add = row
-                results[user_id] = {"count": count, "last_add": last_add}
-            dup_cursor = await db.execute(
-                """
-                SELECT user_id, SUM(c) - COUNT(c)
-                FROM (SELECT user_id, scooter_number, COUNT(*) as c FROM scooter_log WHERE date(timestamp) = ? GROUP BY user_id, scooter_number)
-                WHERE c > 1 GROUP BY user_id
-                """,
-                (today_str,)
-            )
-            async for row in dup_cursor:
-                user_id, dup_count = row
-                if user_id in results:
-                    results[user_id]["duplicates"] = dup_count
+                user_id, count, dup_count, last_add = row
+                results[user_id] = {"count": count, "last_add": last_add or "", "duplicates": dup_count}
         return {"users": results}
 
     # --- ПРАВИЛЬНАЯ ЛОГИКА ДЛЯ ДЕКАД (ВСЕГДА ТЕКУЩИЙ МЕСЯЦ) ---
@@ -224,18 +946,12 @@ async def get_report_stats(period: str, decade_num: Optional[int] = None) -> Dic
         end_date_str = f"{target_year}-{target_month:02d}-{end_day:02d}"
 
         # 3. Выполняем запросы к БД с правильным диапазоном.
-        async with aiosqlite.connect(DB_PATH) as db:
-            live_cursor = await db.execute(
-                "SELECT user_id, COUNT(*) FROM scooter_log WHERE date(timestamp) BETWEEN ? AND ? GROUP BY user_id",
-                (start_date_str, end_date_str))
-            async for row in live_cursor:
-                user_totals[row[0]] = user_totals.get(row[0], 0) + row[1]
-
-            historic_cursor = await db.execute(
-                "SELECT user_id, SUM(count) FROM historic_stats WHERE log_date BETWEEN ? AND ? GROUP BY user_id",
+        async with reader() as db:
+            cursor = await db.execute(
+                "SELECT user_id, SUM(count) FROM daily_totals WHERE day BETWEEN ? AND ? GROUP BY user_id",
                 (start_date_str, end_date_str))
-            async for row in historic_cursor:
-                user_totals[row[0]] = user_totals.get(row[0], 0) + row[1]
+            async for row in cursor:
+                user_totals[row[0]] = row[1]
 
         # Возвращаем итоги, а также месяц/год, за которые они собраны.
         return {
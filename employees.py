@@ -1,14 +1,12 @@
 import json
 
 def load_employees(file_path='data/employees.json'):
+    """Сотрудники из employees.json в словаре по ID, чтобы поиск не перебирал весь список."""
     with open(file_path, encoding='utf-8') as f:
-        return json.load(f)
+        return {emp['id']: emp for emp in json.load(f)}
 
 def get_employee_by_id(user_id, employees):
-    for emp in employees:
-        if emp['id'] == user_id:
-            return emp
-    return None
+    return employees.get(user_id)
 
 # Для теста (можно удалить или оставить для проверки):
 if __name__ == "__main__":
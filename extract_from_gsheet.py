@@ -6,7 +6,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 
 # Импортируем нашу единую функцию подключения
-from g_sheets import get_gsheet_client
+from g_sheets import load_sheet_snapshot
 
 # Загружаем переменные из .env
 load_dotenv()
@@ -32,34 +32,26 @@ def extract_daily_stats():
 
     print(f"Начинаю извлечение данных за {date_input}...")
 
+    with open(config.GRAFIK_PATH, "r", encoding="utf-8") as f:
+        user_config = json.load(f)
+    user_cols = {int(user_id_str): tuple(info["g_sheet_cols"])
+                 for user_id_str, info in user_config.items() if info.get("g_sheet_cols")}
+
     try:
-        client = get_gsheet_client()  # <-- ВЫЗЫВАЕМ ПРАВИЛЬНУЮ ФУНКЦИЮ
-        spreadsheet = client.open_by_url(config.GOOGLE_SHEET_URL)
-        sheet = spreadsheet.worksheet(config.GOOGLE_SHEET_NAME)
-        all_data = sheet.get_all_values()
+        # Общий снимок таблицы: скачиваются только колонки сотрудников, одним запросом
+        rows_by_cols = load_sheet_snapshot(list(dict.fromkeys(user_cols.values())))
         print("Успешно подключился к Google Sheets.")
     except Exception as e:
         print(f"Ошибка подключения к Google Sheets: {e}")
         return
 
-    with open(config.GRAFIK_PATH, "r", encoding="utf-8") as f:
-        user_config = json.load(f)
-
     daily_counts = {}
-    for user_id_str, info in user_config.items():
-        user_id, cols = int(user_id_str), info.get("g_sheet_cols")
-        if not cols: continue
-        num_col_idx, date_col_idx = cols[0] - 1, cols[1] - 1
-        count = 0
-        for row in all_data[1:]:
-            if len(row) > max(num_col_idx, date_col_idx):
-                date_from_sheet = row[date_col_idx].strip()
-                # Проверяем, что дата из таблицы содержит нужную нам часть (например, "12.06")
-                if row[num_col_idx] and date_input in date_from_sheet:
-                    count += 1
+    for user_id, cols in user_cols.items():
+        # Проверяем, что дата из таблицы содержит нужную нам часть (например, "12.06")
+        count = sum(1 for scooter_num, date_str in rows_by_cols[cols] if scooter_num and date_input in date_str.strip())
         if count > 0:
             daily_counts[user_id] = count
-            print(f"Найдено для '{info.get('short_name')}': {count} записей.")
+            print(f"Найдено для '{user_config[str(user_id)].get('short_name')}': {count} записей.")
 
     if not daily_counts:
         print("Не найдено данных за указанную дату.")
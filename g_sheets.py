@@ -1,18 +1,27 @@
 # Файл: g_sheets.py (Версия, готовая к деплою на Railway)
 
 import gspread
+from gspread.utils import ValueInputOption, rowcol_to_a1
+from google.auth.exceptions import RefreshError
 from oauth2client.service_account import ServiceAccountCredentials
 import logging
 import asyncio
 import os
 import json
+import threading
+import time
 from pathlib import Path
-from typing import Dict, Tuple, Optional
+from typing import Callable, Dict, List, Set, Tuple, Optional, TypeVar
 # Добавлен импорт GOOGLE_CREDENTIALS_PATH для локальной работы
-from config import GOOGLE_SHEET_URL, GOOGLE_SHEET_NAME, GOOGLE_CREDENTIALS_PATH
-from datetime import datetime
+from config import (GOOGLE_SHEET_URL, GOOGLE_SHEET_NAME, GOOGLE_CREDENTIALS_PATH,
+                    GSHEET_FLUSH_INTERVAL, GSHEET_FLUSH_MAX_ROWS, GSHEET_CLIENT_MAX_AGE, GSHEET_TOKEN_REFRESH_MARGIN,
+                    GSHEET_CURSOR_TTL, GSHEET_SNAPSHOT_TTL, GSHEET_OUTBOX_MAX_ATTEMPTS)
+import database as db
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
+T = TypeVar("T")
+
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
 
 
@@ -20,9 +29,26 @@ def now_moscow():
     return datetime.now(MOSCOW_TZ)
 
 
-def get_gsheet_client() -> gspread.Client:
+# --- Кэш клиента и листа ---
+# Авторизация и открытие таблицы — это несколько HTTP-запросов, поэтому клиент и лист создаются
+# один раз на процесс и пересоздаются, только когда истекает токен или Google отвечает ошибкой доступа.
+# Функции вызываются из потоков executor'а, поэтому кэш защищен блокировкой.
+_cache_lock = threading.Lock()
+_client: Optional[gspread.Client] = None
+_worksheet: Optional[gspread.Worksheet] = None
+_authorized_at = 0.0
+
+GSHEET_METRICS: Dict[str, int] = {
+    "authorizations": 0,  # Сколько раз строился новый клиент (парсинг кредов + authorize)
+    "worksheet_opens": 0,  # Сколько раз открывались таблица и лист
+    "cache_hits": 0,  # Сколько раз клиент и лист взяты из кэша
+    "auth_error_reconnects": 0,  # Сколько раз переподключались после ошибки доступа
+}
+
+
+def _load_credentials():
     """
-    ЕДИНАЯ ФУНКЦИЯ ДЛЯ ПОДКЛЮЧЕНИЯ К GOOGLE SHEETS.
+    ЕДИНАЯ ФУНКЦИЯ ДЛЯ ПОЛУЧЕНИЯ КРЕДОВ GOOGLE SHEETS.
     Работает и на сервере (через переменные окружения), и локально (через файл).
     """
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
@@ -33,8 +59,7 @@ def get_gsheet_client() -> gspread.Client:
         logging.info("Использую Google креды из переменной окружения.")
         try:
             creds_dict = json.loads(creds_json_str)
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-            return gspread.authorize(creds)
+            return ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
         except Exception as e:
             logging.error(f"Ошибка парсинга GOOGLE_CREDENTIALS_JSON: {e}")
             raise
@@ -42,8 +67,7 @@ def get_gsheet_client() -> gspread.Client:
     # 2. Если переменной нет, используем локальный путь (для тестов на компьютере)
     elif GOOGLE_CREDENTIALS_PATH and Path(GOOGLE_CREDENTIALS_PATH).exists():
         logging.info(f"Использую Google креды из локального файла: {GOOGLE_CREDENTIALS_PATH}")
-        creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_CREDENTIALS_PATH, scope)
-        return gspread.authorize(creds)
+        return ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_CREDENTIALS_PATH, scope)
 
     # 3. Если ничего не найдено, выбрасываем ошибку
     else:
@@ -51,89 +75,421 @@ def get_gsheet_client() -> gspread.Client:
             "Не найдены креды для Google Sheets. Проверьте переменную окружения GOOGLE_CREDENTIALS_JSON или путь GOOGLE_CREDENTIALS_PATH в .env")
 
 
-async def append_to_google_sheets_async(user_short_name: str, scooter_number: str, columns: Optional[Tuple[int, int]]):
-    """Асинхронно добавляет данные в Google Sheets."""
-    if not columns:
-        logging.warning(f"Для пользователя {user_short_name} не заданы колонки в Google Sheets. Пропускаю запись.")
-        return
+def _client_is_stale() -> bool:
+    """Клиент пора пересоздать: его нет, токен скоро истечет или клиент слишком старый."""
+    if _client is None:
+        return True
+    if time.monotonic() - _authorized_at > GSHEET_CLIENT_MAX_AGE:
+        return True
+    # gspread переводит креды oauth2client в google-auth и обновляет токен уже у них (http_client.auth),
+    # исходный объект кредов так и остается без срока. expiry — в наивном UTC; None, пока токен не получен.
+    expiry = getattr(_client.http_client.auth, "expiry", None)
+    return expiry is not None and expiry - datetime.utcnow() < timedelta(seconds=GSHEET_TOKEN_REFRESH_MARGIN)
+
+
+def get_gsheet_client(force_refresh: bool = False) -> gspread.Client:
+    """Возвращает общий для процесса клиент Google Sheets, при необходимости авторизуясь заново."""
+    global _client, _worksheet, _authorized_at
+    with _cache_lock:
+        if force_refresh or _client_is_stale():
+            _client = gspread.authorize(_load_credentials())
+            _worksheet = None
+            _authorized_at = time.monotonic()
+            GSHEET_METRICS["authorizations"] += 1
+            logging.info(f"Google Sheets: новая авторизация. Метрики: {GSHEET_METRICS}")
+        return _client
+
+
+def get_worksheet(force_refresh: bool = False) -> gspread.Worksheet:
+    """Возвращает общий для процесса лист GOOGLE_SHEET_NAME."""
+    global _worksheet
+    client = get_gsheet_client(force_refresh)
+    with _cache_lock:
+        if _worksheet is None:
+            _worksheet = client.open_by_url(GOOGLE_SHEET_URL).worksheet(GOOGLE_SHEET_NAME)
+            GSHEET_METRICS["worksheet_opens"] += 1
+        else:
+            GSHEET_METRICS["cache_hits"] += 1
+        return _worksheet
+
+
+def _is_auth_error(error: Exception) -> bool:
+    if isinstance(error, RefreshError):
+        return True
+    return isinstance(error, gspread.exceptions.APIError) and error.code in (401, 403)
+
+
+def call_with_worksheet(func: Callable[[gspread.Worksheet], T]) -> T:
+    """
+    Выполняет func(лист). Если Google ответил ошибкой авторизации, переподключается
+    с новым токеном и повторяет вызов один раз.
+    """
+    try:
+        return func(get_worksheet())
+    except Exception as e:
+        if not _is_auth_error(e):
+            raise
+        GSHEET_METRICS["auth_error_reconnects"] += 1
+        logging.warning(f"Google Sheets: ошибка доступа ({e}), переподключаюсь. Метрики: {GSHEET_METRICS}")
+        return func(get_worksheet(force_refresh=True))
+
+
+class ColumnCursor:
+    """Следующая свободная строка и уже записанные номера для одной пары колонок (номер, дата)."""
+    __slots__ = ("next_row", "numbers", "seeded_at")
+
+    def __init__(self, existing_numbers: List[str]):
+        self.next_row = len(existing_numbers) + 1
+        self.numbers = set(existing_numbers)
+        self.seeded_at = time.monotonic()
+
+    def advance(self, numbers: List[str]):
+        self.next_row += len(numbers)
+        self.numbers.update(numbers)
+
+
+# Курсоры по парам колонок. Засеваются одним col_values и дальше двигаются локально,
+# а с таблицей сверяются раз в GSHEET_CURSOR_TTL секунд или когда целевые ячейки оказались заняты.
+_column_cursors: Dict[Tuple[int, int], ColumnCursor] = {}
+
+
+def _seed_column_cursor(sheet: gspread.Worksheet, cols: Tuple[int, int]) -> ColumnCursor:
+    cursor = ColumnCursor(sheet.col_values(cols[0]))
+    _column_cursors[cols] = cursor
+    return cursor
+
+
+def _get_column_cursor(sheet: gspread.Worksheet, cols: Tuple[int, int]) -> ColumnCursor:
+    cursor = _column_cursors.get(cols)
+    if cursor is None or time.monotonic() - cursor.seeded_at > GSHEET_CURSOR_TTL:
+        cursor = _seed_column_cursor(sheet, cols)
+    return cursor
+
+
+def _column_range(first_row: int, last_row: int, first_col: int, last_col: int) -> str:
+    return f"{rowcol_to_a1(first_row, first_col)}:{rowcol_to_a1(last_row, last_col)}"
+
+
+def _reserve_outbox_rows(sheet: gspread.Worksheet, rows: List[Tuple],
+                         reserved: Dict[Tuple[int, int], int]) -> List[Tuple[int, int]]:
+    """
+    Выбирает строки листа для новых строк очереди: по порядку, сразу за курсором своей пары колонок.
+    reserved — последние строки, уже закрепленные в очереди за неотправленными сканами: их не занимают повторно,
+    даже если курсор засеян заново, а записать туда еще не успели. Возвращает список (id, строка листа).
+    """
+    rows_by_cols: Dict[Tuple[int, int], List[Tuple]] = {}
+    for row in rows:
+        rows_by_cols.setdefault((row[3], row[4]), []).append(row)
+
+    cursors = {cols: _get_column_cursor(sheet, cols) for cols in rows_by_cols}
+    for cols, cursor in cursors.items():
+        cursor.next_row = max(cursor.next_row, reserved.get(cols, 0) + 1)
+
+    # Целевые ячейки номеров должны быть пустыми. Если кто-то дописал строки вручную,
+    # курсор этой пары засевается заново, чтобы не затереть чужие данные.
+    target_ranges = [
+        _column_range(cursors[cols].next_row, cursors[cols].next_row + len(group) - 1, cols[0], cols[0])
+        for cols, group in rows_by_cols.items()
+    ]
+    for cols, occupied in zip(rows_by_cols, sheet.batch_get(target_ranges)):
+        if any(cell for row in occupied for cell in row):
+            logging.warning(f"Строки после курсора колонок {cols} уже заняты, сверяюсь с таблицей.")
+            cursors[cols] = _seed_column_cursor(sheet, cols)
+            cursors[cols].next_row = max(cursors[cols].next_row, reserved.get(cols, 0) + 1)
+
+    assignments = []
+    for cols, group in rows_by_cols.items():
+        cursor = cursors[cols]
+        added = set()  # Номера этой пачки; уже записанные проверяются по множеству курсора без копирования
+        for offset, row in enumerate(group):
+            scooter_number = row[2]
+            if scooter_number in cursor.numbers or scooter_number in added:
+                logging.warning(f"Найден дубликат {scooter_number}.")
+            added.add(scooter_number)
+            assignments.append((row[0], cursor.next_row + offset))
+        cursor.advance([row[2] for row in group])
+    return assignments
+
+
+def _write_outbox_rows(sheet: gspread.Worksheet, rows: List[Tuple], new_ids: Set[int]) -> None:
+    """
+    Записывает строки из sheets_outbox в закрепленные за ними строки листа одним batch_update.
+    Повторная отправка после сбоя перезаписывает те же ячейки, а не дописывает номер еще раз.
+    Подряд идущие строки одной пары колонок уходят одним диапазоном.
+    """
+    rows_by_cols: Dict[Tuple[int, int], List[Tuple[int, str, str]]] = {}
+    for _, _, scooter_number, number_col, date_col, sheet_time, sheet_row in rows:
+        rows_by_cols.setdefault((number_col, date_col), []).append((sheet_row, scooter_number, sheet_time))
+
+    data = []
+    for (number_col, date_col), values in rows_by_cols.items():
+        values.sort()
+        runs = [[values[0]]]
+        for value in values[1:]:
+            if value[0] == runs[-1][-1][0] + 1:
+                runs[-1].append(value)
+            else:
+                runs.append([value])
+        for run in runs:
+            first_row, last_row = run[0][0], run[-1][0]
+            if date_col == number_col + 1:
+                data.append({
+                    "range": _column_range(first_row, last_row, number_col, date_col),
+                    "values": [[scooter_number, sheet_time] for _, scooter_number, sheet_time in run],
+                })
+            else:
+                data.append({
+                    "range": _column_range(first_row, last_row, number_col, number_col),
+                    "values": [[scooter_number] for _, scooter_number, _ in run],
+                })
+                data.append({
+                    "range": _column_range(first_row, last_row, date_col, date_col),
+                    "values": [[sheet_time] for _, _, sheet_time in run],
+                })
+
+    # Запись и дополнение снимка идут под одной блокировкой: иначе снимок, скачанный между ними,
+    # уже содержал бы эти строки, и они бы задвоились.
+    with _snapshot_lock:
+        # USER_ENTERED — как и у прежнего update_cell, чтобы таблица форматировала значения так же.
+        sheet.batch_update(data, value_input_option=ValueInputOption.user_entered)
+        # В снимок попадают только строки, закрепленные в этой отправке: повтор мог быть записан еще до сбоя,
+        # и снимок его уже содержит (а если нет, увидит при следующем обновлении).
+        for row in rows:
+            cols = (row[3], row[4])
+            if row[0] in new_ids and _snapshot is not None and cols in _snapshot.rows_by_cols:
+                _snapshot.rows_by_cols[cols].append((row[2], row[5]))
+
+
+async def _reserve_rows(rows: List[Tuple]) -> Tuple[List[Tuple], Set[int]]:
+    """
+    Закрепляет строки листа за новыми строками очереди и сохраняет это в БД до записи в таблицу.
+    Возвращает строки с заполненной строкой листа и id тех, что закреплены сейчас.
+    """
+    new_rows = [row for row in rows if row[6] is None]
+    if not new_rows:
+        return rows, set()
+    reserved = await db.get_sheets_outbox_reserved_rows()
+    loop = asyncio.get_running_loop()
+    assignments = await loop.run_in_executor(
+        None, call_with_worksheet, lambda sheet: _reserve_outbox_rows(sheet, new_rows, reserved))
+    try:
+        await db.reserve_sheets_outbox_rows(assignments)
+    except Exception:
+        # Курсоры уже сдвинуты на незакрепленные строки: пусть сверятся с таблицей заново
+        for row in new_rows:
+            _column_cursors.pop((row[3], row[4]), None)
+        raise
+    sheet_rows = dict(assignments)
+    return [row if row[6] is not None else (*row[:6], sheet_rows[row[0]]) for row in rows], set(sheet_rows)
+
 
+async def _send_outbox_rows(rows: List[Tuple], new_ids: Set[int]):
     loop = asyncio.get_running_loop()
-    for attempt in range(3):
+    await loop.run_in_executor(None, call_with_worksheet, lambda sheet: _write_outbox_rows(sheet, rows, new_ids))
+
+
+async def _retry_outbox_rows(rows: List[Tuple], error: Exception):
+    """Откладывает строки до следующей попытки; исчерпавшие GSHEET_OUTBOX_MAX_ATTEMPTS попыток снимаются с отправки."""
+    dead = await db.retry_sheets_outbox([row[0] for row in rows], str(error), GSHEET_OUTBOX_MAX_ATTEMPTS)
+    for row_id, user_id, scooter_number, number_col, date_col in dead:
+        logging.error(
+            f"[ADMIN] Скан {scooter_number} пользователя {user_id} (sheets_outbox.id={row_id}, колонки "
+            f"{number_col}/{date_col}) не записан в Google Sheets за {GSHEET_OUTBOX_MAX_ATTEMPTS} попыток: {error}. "
+            f"Отправка остановлена; чтобы повторить, сбросьте dead_at и attempts у этой строки."
+        )
+
+
+async def flush_sheets_outbox() -> int:
+    """
+    Отправляет в Google Sheets накопившиеся сканы. Возвращает число отправленных строк.
+    Обычно вся пачка уходит одним batch_update. Если он не прошел, пары колонок отправляются по отдельности,
+    чтобы одна сломанная пара (защищенный диапазон, урезанный лист) не держала очередь остальных.
+    """
+    rows = await db.fetch_sheets_outbox(GSHEET_FLUSH_MAX_ROWS)
+    if not rows:
+        return 0
+    try:
+        rows, new_ids = await _reserve_rows(rows)
+    except Exception as e:
+        logging.error(f"Не удалось выбрать строки листа для {len(rows)} сканов, повторю позже: {e}")
+        await _retry_outbox_rows(rows, e)
+        return 0
+    try:
+        await _send_outbox_rows(rows, new_ids)
+    except Exception as e:
+        rows_by_cols: Dict[Tuple[int, int], List[Tuple]] = {}
+        for row in rows:
+            rows_by_cols.setdefault((row[3], row[4]), []).append(row)
+        if len(rows_by_cols) == 1:
+            logging.error(f"Ошибка при записи {len(rows)} строк в Google Sheets, повторю позже: {e}")
+            await _retry_outbox_rows(rows, e)
+            return 0
+        logging.warning(f"Пачка из {len(rows)} строк не записалась в Google Sheets ({e}), отправляю по колонкам.")
+        sent = 0
+        for cols, group in rows_by_cols.items():
+            try:
+                await _send_outbox_rows(group, new_ids)
+            except Exception as group_error:
+                logging.error(f"Ошибка при записи {len(group)} строк в колонки {cols}, повторю позже: {group_error}")
+                await _retry_outbox_rows(group, group_error)
+                continue
+            await db.ack_sheets_outbox([row[0] for row in group])
+            sent += len(group)
+        return sent
+    await db.ack_sheets_outbox([row[0] for row in rows])
+    logging.info(f"В Google Sheets добавлено строк: {len(rows)}.")
+    return len(rows)
+
+
+async def run_sheets_outbox_flusher():
+    """
+    Фоновая задача бота: раз в GSHEET_FLUSH_INTERVAL секунд отправляет очередь sheets_outbox.
+    Очередь хранится в БД, поэтому после перезапуска отправка продолжается с того же места.
+    """
+    while True:
         try:
-            def sync_append():
-                client = get_gsheet_client()
-                spreadsheet = client.open_by_url(GOOGLE_SHEET_URL)
-                sheet = spreadsheet.worksheet(GOOGLE_SHEET_NAME)
-                number_col, date_col = columns
-                next_row = len(sheet.col_values(number_col)) + 1
-                existing_numbers = sheet.col_values(number_col)
-                if scooter_number in existing_numbers:
-                    logging.warning(f"Найден дубликат {scooter_number}.")
-                sheet.update_cell(next_row, number_col, scooter_number)
-                sheet.update_cell(next_row, date_col, now_moscow().strftime("%d.%m. %H:%M"))
-                logging.info(f"Данные для {user_short_name} успешно добавлены в Google Sheets.")
-
-            await loop.run_in_executor(None, sync_append)
-            return
+            while await flush_sheets_outbox() == GSHEET_FLUSH_MAX_ROWS:
+                pass  # Очередь длиннее одной пачки — отправляем дальше без паузы
         except Exception as e:
-            logging.error(f"Ошибка при записи в Google Sheets (попытка {attempt + 1}): {e}")
-            await asyncio.sleep(2)
-    logging.error(f"Не удалось записать данные в Google Sheets для {user_short_name}.")
+            logging.error(f"Сбой фоновой отправки в Google Sheets: {e}")
+        await asyncio.sleep(GSHEET_FLUSH_INTERVAL)
+
+
+def _pair_ranges(cols: Tuple[int, int]) -> List[str]:
+    """Диапазоны для пары колонок без строки заголовка: один, если колонки соседние, иначе два."""
+    number_col, date_col = cols
+    if date_col == number_col + 1:
+        return [f"{rowcol_to_a1(2, number_col)}:{rowcol_to_a1(1, date_col)[:-1]}"]
+    return [f"{rowcol_to_a1(2, col)}:{rowcol_to_a1(1, col)[:-1]}" for col in cols]
+
+
+def fetch_column_pairs(sheet: gspread.Worksheet, pairs: List[Tuple[int, int]]) -> Dict[Tuple[int, int], List[Tuple[str, str]]]:
+    """
+    Одним batch_get скачивает только колонки пользователей (без заголовка)
+    и возвращает для каждой пары список строк (номер, дата).
+    """
+    ranges = [_pair_ranges(cols) for cols in pairs]
+    values = iter(sheet.batch_get([r for pair_ranges in ranges for r in pair_ranges]))
+    result = {}
+    for cols, pair_ranges in zip(pairs, ranges):
+        if len(pair_ranges) == 1:
+            rows = next(values)
+            result[cols] = [(row[0], row[1]) for row in rows if len(row) > 1]
+        else:
+            numbers, dates = next(values), next(values)
+            result[cols] = [(num_row[0] if num_row else "", date_row[0] if date_row else "")
+                            for num_row, date_row in zip(numbers, dates)]
+    return result
+
+
+def _parse_sheet_time(date_str: str) -> Optional[Tuple[int, int]]:
+    """Достает (часы, минуты) из строки вида 'ДД.ММ. ЧЧ:ММ' без strptime; None, если формат другой."""
+    day_part, _, time_part = date_str.partition(" ")
+    hours, _, minutes = time_part.partition(":")
+    if len(day_part) != 6 or not day_part.endswith(".") or not (hours.isdigit() and minutes.isdigit()):
+        return None
+    hour, minute = int(hours), int(minutes)
+    if hour > 23 or minute > 59 or len(minutes) != 2:
+        return None
+    return hour, minute
+
+
+def analyze_today(rows_by_cols: Dict[Tuple[int, int], List[Tuple[str, str]]], user_cols: Dict[int, Tuple[int, int]],
+                  today_check_str: str, current_year: int) -> Dict:
+    """
+    Считает отчет 'За сегодня' за один проход по строкам каждой пары колонок.
+    Строки за другие дни отсекаются проверкой префикса 'ДД.ММ', у сегодняшних разбирается только время.
+    """
+    day, month = map(int, today_check_str.split("."))
+    per_cols = {}
+    for cols, rows in rows_by_cols.items():
+        scooters_today = []
+        latest_time: Optional[Tuple[int, int]] = None
+        for scooter_num, date_str in rows:
+            date_str = date_str.strip()
+            if not scooter_num or not date_str.startswith(today_check_str):
+                continue
+            scooters_today.append(scooter_num)
+            current_time = _parse_sheet_time(date_str)
+            if current_time is None:
+                logging.warning(f"Не удалось распознать формат даты '{date_str}' в Google Sheet.")
+            elif latest_time is None or current_time > latest_time:
+                latest_time = current_time
+        if scooters_today:
+            per_cols[cols] = {
+                "count": len(scooters_today),
+                "last_add": datetime(current_year, month, day, *latest_time).isoformat() if latest_time else "",
+                "duplicates": len(scooters_today) - len(set(scooters_today)),
+            }
+
+    return {"users": {user_id: dict(per_cols[cols]) for user_id, cols in user_cols.items() if cols in per_cols}}
+
+
+# --- Снимок колонок таблицы ---
+# Отчеты и выгрузка читают таблицу через общий снимок с TTL. Одновременные запросы ждут одно скачивание,
+# а отправка из sheets_outbox дописывает свои строки в снимок, чтобы он не отставал между обновлениями.
+class SheetSnapshot:
+    __slots__ = ("rows_by_cols", "fetched_at")
+
+    def __init__(self, rows_by_cols: Dict[Tuple[int, int], List[Tuple[str, str]]]):
+        self.rows_by_cols = rows_by_cols
+        self.fetched_at = time.monotonic()
+
+    def covers(self, pairs: List[Tuple[int, int]], max_age: float) -> bool:
+        return time.monotonic() - self.fetched_at <= max_age and all(cols in self.rows_by_cols for cols in pairs)
+
+
+_snapshot: Optional[SheetSnapshot] = None
+_snapshot_lock = threading.Lock()
+_snapshot_download: Optional[asyncio.Future] = None
+
+
+def load_sheet_snapshot(pairs: List[Tuple[int, int]],
+                        max_age: float = GSHEET_SNAPSHOT_TTL) -> Dict[Tuple[int, int], List[Tuple[str, str]]]:
+    """Синхронно возвращает строки (номер, дата) для пар колонок: из снимка или, если он устарел, из таблицы."""
+    global _snapshot
+    with _snapshot_lock:
+        snapshot = _snapshot
+        if snapshot is None or not snapshot.covers(pairs, max_age):
+            # Заодно скачиваем пары из старого снимка, чтобы он оставался полным для других отчетов.
+            all_pairs = list(dict.fromkeys([*pairs, *(snapshot.rows_by_cols if snapshot else ())]))
+            snapshot = SheetSnapshot(call_with_worksheet(lambda sheet: fetch_column_pairs(sheet, all_pairs)))
+            _snapshot = snapshot
+            logging.info(f"Снимок Google Sheets обновлен: колонок {len(all_pairs)}.")
+        return snapshot.rows_by_cols
+
+
+async def get_sheet_snapshot(pairs: List[Tuple[int, int]]) -> Dict[Tuple[int, int], List[Tuple[str, str]]]:
+    """
+    Асинхронная версия load_sheet_snapshot: свежий снимок отдается сразу,
+    а если нужно скачивание, все одновременные вызовы ждут одно и то же.
+    """
+    global _snapshot_download
+    if _snapshot is not None and _snapshot.covers(pairs, GSHEET_SNAPSHOT_TTL):
+        return _snapshot.rows_by_cols
+    if _snapshot_download is None or _snapshot_download.done():
+        loop = asyncio.get_running_loop()
+        _snapshot_download = loop.run_in_executor(None, load_sheet_snapshot, pairs)
+    rows_by_cols = await asyncio.shield(_snapshot_download)
+    if all(cols in rows_by_cols for cols in pairs):
+        return rows_by_cols
+    # Скачивание, к которому мы присоединились, было для других колонок.
+    return await asyncio.get_running_loop().run_in_executor(None, load_sheet_snapshot, pairs)
 
 
 async def get_live_report_from_gsheet_async() -> Dict:
     """Читает данные напрямую из Google Sheets для отчета 'За сегодня'."""
-    from utils import USER_DATA
-    loop = asyncio.get_running_loop()
-
-    def sync_read_and_analyze():
-        client = get_gsheet_client()
-        spreadsheet = client.open_by_url(GOOGLE_SHEET_URL)
-        sheet = spreadsheet.worksheet(GOOGLE_SHEET_NAME)
-        all_data = sheet.get_all_values()
-        today_check_str = now_moscow().strftime("%d.%m")
-        results = {}
-        current_year = now_moscow().year
-
-        for user_id_str, user_info in USER_DATA.items():
-            user_id = int(user_id_str)
-            cols = user_info.get("g_sheet_cols")
-            if not cols: continue
-
-            num_col_idx, date_col_idx = cols[0] - 1, cols[1] - 1
-            user_scooters_today = []
-            latest_timestamp_dt: Optional[datetime] = None
-
-            for row in all_data[1:]:
-                if len(row) > max(num_col_idx, date_col_idx):
-                    scooter_num, date_str = row[num_col_idx], row[date_col_idx]
-
-                    if scooter_num and date_str.strip().startswith(today_check_str):
-                        user_scooters_today.append(scooter_num)
-                        try:
-                            current_dt = datetime.strptime(date_str.strip(), "%d.%m. %H:%M").replace(year=current_year)
-                            if latest_timestamp_dt is None or current_dt > latest_timestamp_dt:
-                                latest_timestamp_dt = current_dt
-                        except ValueError:
-                            logging.warning(f"Не удалось распознать формат даты '{date_str}' в Google Sheet.")
-                            pass
-
-            if user_scooters_today:
-                count = len(user_scooters_today)
-                duplicates = count - len(set(user_scooters_today))
-                iso_timestamp = latest_timestamp_dt.isoformat() if latest_timestamp_dt else ""
-
-                results[user_id] = {
-                    "count": count,
-                    "last_add": iso_timestamp,
-                    "duplicates": duplicates
-                }
-
-        return {"users": results}
+    from utils import USERS
+    user_cols = {user.user_id: user.sheet_cols for user in USERS.all() if user.sheet_cols}
+    pairs = list(dict.fromkeys(user_cols.values()))
 
+    if not pairs:
+        return {"users": {}}
     try:
-        stats = await loop.run_in_executor(None, sync_read_and_analyze)
-        return stats
+        rows_by_cols = await get_sheet_snapshot(pairs)
+        now = now_moscow()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, analyze_today, rows_by_cols, user_cols, now.strftime("%d.%m"), now.year)
     except Exception as e:
         logging.error(f"Ошибка при чтении данных из Google Sheets для отчета: {e}")
-        return {"users": {}}
\ No newline at end of file
+        return {"users": {}}
@@ -0,0 +1,54 @@
+# Файл: leaderboard.py (рейтинг сотрудников в памяти процесса)
+
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Tuple
+
+
+class Leaderboard:
+    """
+    Общий рейтинг по количеству самокатов за все время.
+    Хранит отсортированный список (-итог, user_id), поэтому место пользователя ищется бинарным поиском.
+    При равных итогах выше стоит пользователь с меньшим ID.
+    """
+
+    def __init__(self):
+        self._totals: Dict[int, int] = {}
+        self._order: List[Tuple[int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._totals)
+
+    def rebuild(self, totals: Dict[int, int]):
+        """Полностью заменяет рейтинг итогами из БД."""
+        order = sorted((-total, user_id) for user_id, total in totals.items())
+        self._totals, self._order = dict(totals), order
+
+    def set_total(self, user_id: int, total: int):
+        """Устанавливает итог пользователя и переставляет его на нужное место."""
+        old_total = self._totals.get(user_id)
+        if old_total == total:
+            return
+        if old_total is not None:
+            del self._order[bisect_left(self._order, (-old_total, user_id))]
+        self._totals[user_id] = total
+        insort(self._order, (-total, user_id))
+
+    def remove(self, user_id: int):
+        """Убирает пользователя из рейтинга (например, после удаления всех его сканов)."""
+        total = self._totals.pop(user_id, None)
+        if total is not None:
+            del self._order[bisect_left(self._order, (-total, user_id))]
+
+    def total(self, user_id: int) -> int:
+        return self._totals.get(user_id, 0)
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """Место пользователя в рейтинге (с 1) или None, если у него еще нет ни одного самоката."""
+        total = self._totals.get(user_id)
+        if total is None:
+            return None
+        return bisect_left(self._order, (-total, user_id)) + 1
+
+    def top(self, n: int) -> List[Tuple[int, int]]:
+        """Первые n мест в виде списка (user_id, итог)."""
+        return [(user_id, -neg_total) for neg_total, user_id in self._order[:n]]
@@ -1,38 +1,31 @@
 # Файл: main.py (ФИНАЛЬНАЯ, БЛЯДЬ, ВЕРСИЯ)
 
-import os
-import re
 import asyncio
 import logging
-from pathlib import Path
 from typing import Optional, Dict
 
-import cv2
-import pytesseract
-from pyzbar.pyzbar import decode
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatAction
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import nest_asyncio
 
 # Импорт из наших модулей
+import broadcast
 import config
 import database as db
 import g_sheets
+import recognition
+import roster
+import router
+import update_processor
 import utils
 
 # --- Настройка ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 nest_asyncio.apply()
 
-if config.TESSERACT_CMD and os.path.exists(config.TESSERACT_CMD):
-    pytesseract.pytesseract.tesseract_cmd = config.TESSERACT_CMD
-else:
-    logging.warning("Путь к Tesseract-OCR не найден или не указан.")
-
-NUMBER_PATTERN = re.compile(r'(?:\b00\d{6}\b|\b\d{6,8}\b)')
+NUMBER_PATTERN = recognition.NUMBER_PATTERN
 user_broadcast_state: Dict[int, bool] = {}
-last_broadcast_info: Dict = {}
 
 
 # --- Функции для рассылки ---
@@ -47,61 +40,53 @@ async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def send_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: Optional[str] = None,
                                  photo_file_id: Optional[str] = None):
     sender_id = update.message.from_user.id
-    sender_name = utils.USER_NAMES.get(sender_id, f"ID {sender_id}")
+    sender_name = utils.USERS.name(sender_id)
     caption = text or update.message.caption or ""
     full_message = f"📢 Сообщение от: *{sender_name}*\n\n{caption}"
-    recipients = [uid for uid_str, data in utils.USER_DATA.items() if
-                  data.get("permissions") == "user" and (uid := int(uid_str)) != sender_id]
+    recipients = [uid for uid in utils.USERS.ids_with_permission("user") if uid != sender_id]
     if not recipients:
         await context.bot.send_message(chat_id=sender_id, text="Не найдено сотрудников для рассылки.")
         return
 
-    global last_broadcast_info
-    last_broadcast_info = {'sender_id': sender_id, 'message_text': caption, 'recipients': recipients, 'message_ids': {},
-                           'accepted': set(), 'skipped': set()}
+    state = broadcast.new_broadcast(sender_id, caption, recipients)
     reply_markup = ReplyKeyboardMarkup([[config.BUTTON_ACCEPT_BROADCAST, config.BUTTON_SKIP_BROADCAST]],
                                        resize_keyboard=True)
 
-    successful_sends, failed_sends = 0, 0
-    for user_id in recipients:
-        try:
-            msg = await (context.bot.send_photo if photo_file_id else context.bot.send_message)(
-                chat_id=user_id,
-                **(dict(photo=photo_file_id, caption=full_message) if photo_file_id else dict(text=full_message)),
-                parse_mode="Markdown", reply_markup=reply_markup
-            )
-            last_broadcast_info['message_ids'][user_id] = msg.message_id
-            successful_sends += 1
-        except Exception as e:
-            logging.error(f"Не удалось отправить рассылку пользователю {user_id}: {e}")
-            failed_sends += 1
-
+    async def send(user_id: int):
+        if photo_file_id:
+            return await context.bot.send_photo(chat_id=user_id, photo=photo_file_id, caption=full_message,
+                                                parse_mode="Markdown", reply_markup=reply_markup)
+        return await context.bot.send_message(chat_id=user_id, text=full_message, parse_mode="Markdown",
+                                              reply_markup=reply_markup)
+
+    async def run():
+        result = await broadcast.run_broadcast(context.bot, sender_id, recipients, send,
+                                               on_sent=state.remember_message)
+        await context.bot.send_message(
+            chat_id=sender_id,
+            text=f"✅ Рассылка завершена!\nУспешно: {len(result.message_ids)}, Ошибок: {len(result.failed)}",
+            reply_markup=utils.get_user_reply_markup(sender_id)
+        )
+
+    # Рассылка идет в фоне: обработчик сразу освобождается, и бот продолжает принимать сканы
     user_broadcast_state[sender_id] = False
-    await context.bot.send_message(
-        chat_id=sender_id, text=f"✅ Рассылка завершена!\nУспешно: {successful_sends}, Ошибок: {failed_sends}",
-        reply_markup=utils.get_user_reply_markup(sender_id)
-    )
+    context.application.create_task(run(), update=update)
 
 
 async def handle_broadcast_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    if not last_broadcast_info or user_id not in last_broadcast_info.get('recipients', []): return
-    action = 'accepted' if update.message.text == config.BUTTON_ACCEPT_BROADCAST else 'skipped'
-    last_broadcast_info[action].add(user_id)
-    if original_msg_id := last_broadcast_info['message_ids'].get(user_id):
+    reply_to = update.message.reply_to_message
+    state = broadcast.find_broadcast_for_reply(user_id, reply_to.message_id if reply_to else None)
+    if state is None: return
+    accepted = update.message.text == config.BUTTON_ACCEPT_BROADCAST
+    state.record_reply(user_id, utils.USERS.name(user_id), accepted)
+    if original_msg_id := state.message_ids.get(user_id):
         try:
             await context.bot.delete_message(chat_id=user_id, message_id=original_msg_id)
         except Exception:
             pass
     await update.message.reply_text("Ваш ответ принят.", reply_markup=utils.get_user_reply_markup(user_id))
-    if sender_id := last_broadcast_info.get('sender_id'):
-        accepted = sorted([utils.USER_NAMES.get(uid) for uid in last_broadcast_info['accepted']])
-        skipped = sorted([utils.USER_NAMES.get(uid) for uid in last_broadcast_info['skipped']])
-        report_text = f"📢 Отчет:\n✅ Приняли ({len(accepted)}): {', '.join(accepted) or '-'}\n⏭ Пропустили ({len(skipped)}): {', '.join(skipped) or '-'}"
-        try:
-            await context.bot.send_message(chat_id=sender_id, text=report_text, parse_mode="Markdown")
-        except Exception as e:
-            logging.error(f"Не удалось отправить отчет о рассылке {sender_id}: {e}")
+    broadcast.schedule_report(context.bot, state)
 
 
 # --- Основные обработчики ---
@@ -115,41 +100,34 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def process_and_add_scooter(user_id: int, scooter_number: str):
-    await db.add_scooter(user_id, scooter_number)
-    await db.update_last_activity(user_id)
-    user_data = utils.USER_DATA.get(str(user_id), {})
-    asyncio.create_task(
-        g_sheets.append_to_google_sheets_async(user_data.get("short_name", ""), scooter_number,
-                                               user_data.get("g_sheet_cols"))
-    )
+    user = utils.USERS.get(user_id)
+    sheet_cols = user.sheet_cols if user else None
+    if not sheet_cols:
+        logging.warning(f"Для пользователя {user.short_name if user else user_id} не заданы колонки в Google Sheets. "
+                        f"Пропускаю запись.")
+    # Скан и строка для Google Sheets сохраняются в БД одной транзакцией; в таблицу ее допишет фоновая отправка.
+    await db.add_scooter(user_id, scooter_number, sheet_cols)
 
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Текст, который не является кнопкой: сообщение рассылки или номер самоката. Доступ уже проверил TextRouter."""
     user_id = update.message.from_user.id
     text = update.message.text
-    if not utils.is_user_allowed(user_id): return
 
-    # Проверяем, является ли текст названием кнопки, которую нужно игнорировать
-    # Это предотвращает краш, когда пользователь нажимает WebApp кнопку
-    if text == config.BUTTON_MY_STATS:
-        logging.info(f"Пользователь {user_id} нажал WebApp кнопку 'Моя статистика'. Игнорируем текстовое сообщение.")
-        return
-
-    if utils.is_special_user(user_id) and user_broadcast_state.get(user_id):
+    if user_broadcast_state.get(user_id) and utils.is_special_user(user_id):
         await send_broadcast_message(update, context, text=text)
-    elif NUMBER_PATTERN.search(text):
-        number = NUMBER_PATTERN.search(text).group(0)
+    elif match := NUMBER_PATTERN.search(text):
+        number = match.group(0)
         await process_and_add_scooter(user_id, number)
         await update.message.reply_text(f"Самокат {number} сохранён.")
     else:
-        # Если это не команда и не номер, проверяем, не является ли это текстом с другой кнопки
-        # Это нужно, чтобы бот не отвечал "Команда не распознана" на каждую кнопку
-        all_buttons = [config.BUTTON_MY_SHIFTS, config.BUTTON_RETURN, config.BUTTON_CONTACT_ADMIN, config.BUTTON_TABLE,
-                       config.BUTTON_VYGRUZKA, config.BUTTON_TODAY_REPORT, config.BUTTON_DEKADA_1,
-                       config.BUTTON_DEKADA_2, config.BUTTON_DEKADA_3, config.BUTTON_BROADCAST,
-                       config.BUTTON_ACCEPT_BROADCAST, config.BUTTON_SKIP_BROADCAST, config.BUTTON_INFO]
-        if text not in all_buttons:
-            await update.message.reply_text("Команда не распознана.")
+        await update.message.reply_text("Команда не распознана.")
+
+
+async def handle_my_stats_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Это предотвращает краш, когда пользователь нажимает WebApp кнопку
+    logging.info(f"Пользователь {update.message.from_user.id} нажал WebApp кнопку 'Моя статистика'. "
+                 f"Игнорируем текстовое сообщение.")
 
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -160,21 +138,24 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     await context.bot.send_chat_action(chat_id=update.message.chat_id, action=ChatAction.TYPING)
-    photo_file = await update.message.photo[-1].get_file()
-    config.TEMP_DIR.mkdir(exist_ok=True)
-    file_path = config.TEMP_DIR / f"{photo_file.file_id}.jpg"
-    await photo_file.download_to_drive(file_path)
+    photo = update.message.photo[-1]
+
+    async def download_photo() -> bytearray:
+        photo_file = await photo.get_file()
+        return await photo_file.download_as_bytearray()
+
+    try:
+        scooter_number = await recognition.recognize_photo(user_id, photo.file_unique_id, download_photo)
+    except recognition.RecognitionBusy:
+        logging.warning(f"Очередь распознавания заполнена, фото пользователя {user_id} отклонено.")
+        await update.message.reply_text("Сейчас много фото в обработке. Отправьте фото еще раз через минуту.")
+        return
 
-    scooter_number = extract_number_from_image(str(file_path))
     if scooter_number:
         await process_and_add_scooter(user_id, scooter_number)
         await update.message.reply_text(f"Распознан номер {scooter_number}. Данные сохранены.")
     else:
         await update.message.reply_text("Не удалось распознать номер самоката на фото.")
-    try:
-        os.remove(file_path)
-    except OSError as e:
-        logging.error(f"Не удалось удалить временный файл {file_path}: {e}")
 
 
 async def handle_vygruzka(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -246,34 +227,35 @@ async def handle_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logging.warning(f"Инфо-фото не найдено по пути: {photo_path}")
 
 
-def rotate_image(image, angle):
-    (h, w) = image.shape[:2];
-    center = (w / 2, h / 2)
-    M = cv2.getRotationMatrix2D(center, angle, 1.0);
-    return cv2.warpAffine(image, M, (w, h))
+REPORT_BUTTONS = frozenset({config.BUTTON_TODAY_REPORT, config.BUTTON_DEKADA_1, config.BUTTON_DEKADA_2,
+                            config.BUTTON_DEKADA_3})
 
 
-def extract_number_from_image(image_path: str) -> Optional[str]:
-    try:
-        image = cv2.imread(image_path)
-        if image is None: return None
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        for angle in [0, 90, 180, 270]:
-            for obj in decode(rotate_image(gray, angle)):
-                if match := re.search(r'\d{8}', obj.data.decode("utf-8")):
-                    return match.group(0)
-        if match := NUMBER_PATTERN.search(pytesseract.image_to_string(gray, config='--psm 6')):
-            return match.group(0)
-    except Exception as e:
-        logging.error(f"Ошибка при обработке изображения {image_path}: {e}")
+def classify_update(update: Update) -> Optional[str]:
+    """Класс апдейта для лимитов UPDATES_CLASS_LIMITS (None — только общий лимит)."""
+    message = update.message
+    if message is None or message.from_user is None:
+        return None
+    if user_broadcast_state.get(message.from_user.id) and (message.photo or message.text):
+        return "broadcast"
+    if message.photo:
+        return "ocr"
+    if message.text in REPORT_BUTTONS:
+        return "reports"
     return None
 
 
 async def main():
     utils.load_user_data()
     await db.init_db()
+    await roster.sync_roster(force=True)
+    await recognition.load_recognition_cache()
+    recognition.start_recognition_pool()
+    processor = update_processor.UserOrderedUpdateProcessor(config.UPDATES_CONCURRENCY, config.UPDATES_CLASS_LIMITS,
+                                                            classify_update)
     # ВРЕМЕННАЯ ХУЙНЯ ДЛЯ ТЕСТА
-    application = Application.builder().token("7839713101:AAFcPH9XPx5aZOI52IBbLXKzNwK4QB4F47E").build()
+    application = (Application.builder().token("7839713101:AAFcPH9XPx5aZOI52IBbLXKzNwK4QB4F47E")
+                   .concurrent_updates(processor).build())
 
     application.add_handler(CommandHandler("start", start))
 
@@ -292,17 +274,22 @@ async def main():
         config.BUTTON_ACCEPT_BROADCAST: handle_broadcast_reply,
         config.BUTTON_SKIP_BROADCAST: handle_broadcast_reply,
         config.BUTTON_INFO: handle_info,
+        config.BUTTON_MY_STATS: handle_my_stats_button,
     }
-    for button_text, callback in button_handlers.items():
-        application.add_handler(MessageHandler(
-            filters.TEXT & filters.Regex(f"^{re.escape(button_text)}$") & filters.Chat(
-                chat_id=list(map(int, utils.USER_DATA.keys()))), callback))
+    text_router = router.TextRouter(button_handlers, handle_text_message, is_allowed=utils.USERS.is_allowed)
 
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_router))
+
+    sheets_flusher = asyncio.create_task(g_sheets.run_sheets_outbox_flusher())
 
     logging.info("Бот запускается...")
-    await application.run_polling()
+    try:
+        await application.run_polling()
+    finally:
+        sheets_flusher.cancel()
+        recognition.shutdown_recognition_pool()
+        await db.close_db()
 
 
 if __name__ == '__main__':
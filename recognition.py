@@ -0,0 +1,492 @@
+# Файл: recognition.py (распознавание номера самоката на фото в пуле процессов)
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import config
+import database as db
+from recognition_cache import CachedRecognition, RecognitionCache
+
+NUMBER_PATTERN = re.compile(r'(?:\b00\d{6}\b|\b\d{6,8}\b)')
+
+# --- Пул процессов ---
+# OpenCV, pyzbar и Tesseract держат GIL и процессор сотни миллисекунд, поэтому распознавание
+# идет в отдельных процессах, а цикл событий бота в это время обслуживает остальных пользователей.
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = config.OCR_WORKERS
+_pool_lock = asyncio.Lock()  # Один перезапуск пула за раз
+_pending_jobs = 0  # Задачи, еще занимающие рабочий процесс (в том числе те, что бот перестал ждать)
+
+# --- Кэш результатов ---
+# Одно и то же фото часто пересылают повторно: по file_unique_id номер берется без скачивания,
+# а тот же файл под другим file_unique_id узнается по хэшу содержимого без запуска каскада.
+RECOGNITION_CACHE = RecognitionCache(config.RECOGNITION_CACHE_SIZE)
+RECOGNITION_METRICS: Dict[str, int] = {
+    "memory_hits": 0,  # Номер найден в памяти по file_unique_id
+    "disk_hits": 0,  # Номер найден в БД по file_unique_id
+    "content_hits": 0,  # Номер взят у файла с точно таким же содержимым
+    "misses": 0,  # Фото пришлось распознавать
+}
+_last_prune = 0.0  # time.monotonic() последней чистки кэша в БД
+
+
+# --- OCR в рабочем процессе ---
+# Если установлен tesserocr (привязка к C API Tesseract), каждый рабочий процесс один раз создает
+# свои движки и дальше распознает прямо из памяти. Без него каждый вызов pytesseract запускает
+# процесс tesseract, пишет кадр во временный файл и заново грузит языковые данные.
+_ocr_engines: Dict[str, object] = {}
+
+
+class RecognitionBusy(Exception):
+    """Очередь распознавания заполнена, новое фото не принято."""
+
+
+def _init_worker(tesseract_cmd: Optional[str]):
+    """Инициализация рабочего процесса: тяжелые библиотеки загружаются один раз, до первого фото."""
+    import cv2
+    import pytesseract
+    import pyzbar.pyzbar  # noqa: F401 — загружает libzbar заранее
+
+    # Параллелизм дает пул процессов; внутренние потоки OpenCV только мешали бы соседним процессам.
+    cv2.setNumThreads(1)
+    if tesseract_cmd and os.path.exists(tesseract_cmd):
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    else:
+        logging.warning("Путь к Tesseract-OCR не найден или не указан.")
+    _init_ocr_engines()
+
+
+def _init_ocr_engines():
+    """Создает постоянные движки Tesseract: для блоков цифр (только цифры) и для всего кадра."""
+    try:
+        import tesserocr
+    except ImportError:
+        logging.info("tesserocr не установлен, OCR будет через pytesseract.")
+        return
+    try:
+        digits = tesserocr.PyTessBaseAPI(lang="eng", psm=tesserocr.PSM.SINGLE_BLOCK)
+        digits.SetVariable("tessedit_char_whitelist", "0123456789")
+        text = tesserocr.PyTessBaseAPI(lang="eng", psm=tesserocr.PSM.SINGLE_BLOCK)
+    except RuntimeError as e:
+        logging.warning(f"Не удалось запустить tesserocr ({e}), OCR будет через pytesseract.")
+        return
+    _ocr_engines.update(digits=digits, text=text)
+
+
+def _ocr(gray, digits_only: bool) -> str:
+    """Текст на полутоновом кадре: постоянным движком tesserocr, а если его нет — через pytesseract."""
+    engine = _ocr_engines.get("digits" if digits_only else "text")
+    if engine is not None:
+        try:
+            engine.SetImageBytes(gray.tobytes(), gray.shape[1], gray.shape[0], 1, gray.shape[1])
+            return engine.GetUTF8Text()
+        except RuntimeError as e:
+            logging.error(f"Ошибка tesserocr, повтор через pytesseract: {e}")
+    import pytesseract
+    # pytesseract запускает отдельный процесс tesseract и убивает его по таймауту (RuntimeError)
+    return pytesseract.image_to_string(gray, config=TESSERACT_DIGITS_CONFIG if digits_only else "--psm 6",
+                                       timeout=config.OCR_TESSERACT_TIMEOUT)
+
+
+def _ping() -> Tuple[int, str]:
+    """PID рабочего процесса и движок OCR, который он получил при запуске."""
+    return os.getpid(), "tesserocr" if _ocr_engines else "pytesseract"
+
+
+def decode_image(buffer):
+    """Декодирует JPEG/PNG из буфера в памяти (bytes, bytearray, memoryview) в BGR-массив OpenCV."""
+    import cv2
+    import numpy as np
+    return cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+# --- Каскад распознавания ---
+# Этапы идут от дешевых к дорогим, и каждый следующий запускается только если предыдущие не нашли номер:
+# QR на уменьшенном кадре -> QR в вырезанной области -> повороты этой области -> OCR блока цифр -> OCR всего кадра.
+QR_ROI_MARGIN = 0.15  # На сколько (доля стороны) расширять найденную область QR перед вырезкой
+DIGITS_ROI_CANDIDATES = 3  # Сколько найденных блоков цифр отдавать в OCR
+DIGITS_MIN_HEIGHT = 40  # До какой высоты (пикс.) увеличивать вырезанный блок цифр перед OCR
+TESSERACT_DIGITS_CONFIG = "--psm 6 -c tessedit_char_whitelist=0123456789"
+
+
+def _lap(timings: Optional[Dict[str, float]], stage: str, started: float) -> float:
+    """Записывает длительность этапа в мс и возвращает момент его окончания (начало следующего)."""
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = (now - started) * 1000
+    return now
+
+
+def _number_from_qr(gray) -> Optional[str]:
+    from pyzbar.pyzbar import decode
+    for obj in decode(gray):
+        if match := re.search(r'\d{8}', obj.data.decode("utf-8")):
+            return match.group(0)
+    return None
+
+
+def _downscale(gray, max_side: int):
+    """Уменьшает кадр так, чтобы большая сторона была не больше max_side. Возвращает кадр и масштаб."""
+    import cv2
+    scale = min(1.0, max_side / max(gray.shape[:2]))
+    if scale == 1.0:
+        return gray, 1.0
+    return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+
+
+def _crop(gray, x: float, y: float, w: float, h: float, margin: float):
+    """Вырезает прямоугольник с запасом margin от его сторон, не выходя за границы кадра."""
+    dx, dy = w * margin, h * margin
+    top, left = max(0, int(y - dy)), max(0, int(x - dx))
+    return gray[top:int(y + h + dy) + 1, left:int(x + w + dx) + 1]
+
+
+def _find_qr_roi(small, scale: float, gray):
+    """Ищет QR по искателям (три квадрата по углам) на уменьшенном кадре и вырезает его из полного."""
+    import cv2
+    found, points = cv2.QRCodeDetector().detect(small)
+    if not found or points is None:
+        return None
+    x, y, w, h = cv2.boundingRect((points.reshape(-1, 2) / scale).astype("int32"))
+    roi = _crop(gray, x, y, w, h, QR_ROI_MARGIN)
+    return roi if roi.size else None
+
+
+def _char_boxes(mask, frame_height: int) -> list:
+    """Прямоугольники контуров, похожих по размеру и пропорциям на отдельную цифру."""
+    import cv2
+    contours, _ = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if frame_height * 0.015 <= h <= frame_height * 0.25 and 0.2 * h <= w <= 1.2 * h:
+            boxes.append((x, y, w, h))
+    return boxes
+
+
+def _group_lines(boxes: list) -> list:
+    """Склеивает цифры одной высоты, идущие подряд слева направо, в строки [x, y, w, h, цифр]."""
+    lines = []
+    for x, y, w, h in sorted(boxes):
+        for line in lines:
+            lx, ly, lw, lh, count = line
+            if (abs((y + h / 2) - (ly + lh / 2)) < lh * 0.35 and 0 <= x - (lx + lw) < lh
+                    and abs(h - lh) < lh * 0.4):
+                top = min(ly, y)
+                line[:] = [lx, top, max(lx + lw, x + w) - lx, max(ly + lh, y + h) - top, count + 1]
+                break
+        else:
+            lines.append([x, y, w, h, 1])
+    return [line for line in lines if line[4] >= 3]
+
+
+def _stack_lines(lines: list) -> list:
+    """Объединяет строки друг под другом (номер на заднем номерном знаке в две строки) в блоки."""
+    blocks = []
+    for x, y, w, h, count in sorted(lines, key=lambda line: line[1]):
+        for block in blocks:
+            bx, by, bw, bh, bcount, line_h = block
+            if 0 <= y - (by + bh) < line_h and abs(x - bx) < line_h and abs(h - line_h) < line_h * 0.4:
+                left = min(bx, x)
+                block[:] = [left, by, max(bx + bw, x + w) - left, y + h - by, bcount + count, line_h]
+                break
+        else:
+            blocks.append([x, y, w, h, count, h])
+    return [block[:5] for block in blocks if block[4] >= 6]
+
+
+def _find_digit_rois(small, scale: float, gray) -> list:
+    """
+    Ищет на уменьшенном кадре блоки из 6+ цифр: контуры размером с символ склеиваются в строки,
+    строки друг под другом — в блоки. Темные цифры на светлом и светлые на темном ищутся отдельно.
+    Возвращает вырезки из полного кадра, от блока с наибольшим числом символов.
+    """
+    import cv2
+    blocks = []
+    for polarity in (cv2.THRESH_BINARY_INV, cv2.THRESH_BINARY):
+        _, mask = cv2.threshold(small, 0, 255, polarity | cv2.THRESH_OTSU)
+        blocks += _stack_lines(_group_lines(_char_boxes(mask, small.shape[0])))
+    blocks.sort(key=lambda block: block[4], reverse=True)
+
+    rois, taken = [], []
+    for x, y, w, h, _ in blocks:
+        cx, cy = x + w / 2, y + h / 2
+        # Один и тот же блок часто находится в обеих полярностях
+        if any(tx <= cx <= tx + tw and ty <= cy <= ty + th for tx, ty, tw, th in taken):
+            continue
+        taken.append((x, y, w, h))
+        roi = _crop(gray, x / scale, y / scale, w / scale, h / scale, 0.1)
+        if roi.size:
+            rois.append(roi)
+        if len(rois) == DIGITS_ROI_CANDIDATES:
+            break
+    return rois
+
+
+def _ocr_digits(roi) -> Optional[str]:
+    """OCR блока цифр: увеличение мелкого блока, бинаризация Оцу, Tesseract только по цифрам."""
+    import cv2
+    if roi.shape[0] < DIGITS_MIN_HEIGHT:
+        factor = DIGITS_MIN_HEIGHT / roi.shape[0]
+        roi = cv2.resize(roi, None, fx=factor, fy=factor, interpolation=cv2.INTER_CUBIC)
+    _, binary = cv2.threshold(roi, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    # Строки блока (0024 / 7094 на номерном знаке) склеиваются в один номер
+    digits = "".join(_ocr(binary, digits_only=True).split())
+    if match := NUMBER_PATTERN.search(digits):
+        return match.group(0)
+    return None
+
+
+def extract_number_from_image(image, timings: Optional[Dict[str, float]] = None) -> Optional[str]:
+    """
+    Ищет номер самоката на BGR-кадре каскадом этапов с ранним выходом.
+    Если передан timings, в него пишется длительность каждого выполненного этапа в мс;
+    последний записанный этап и есть тот, что нашел номер (или последний неудачный).
+    """
+    import cv2
+    try:
+        if image is None: return None
+        started = time.perf_counter()
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        small, scale = _downscale(gray, config.OCR_FAST_MAX_SIDE)
+        started = _lap(timings, "prepare", started)
+
+        number = _number_from_qr(small)
+        started = _lap(timings, "qr_fast", started)
+        if number: return number
+
+        qr_roi = _find_qr_roi(small, scale, gray)
+        if qr_roi is not None:
+            number = _number_from_qr(qr_roi)
+        started = _lap(timings, "qr_roi", started)
+        if number: return number
+
+        # Поворачивать имеет смысл только найденный, но не прочитанный QR; cv2.rotate — без интерполяции.
+        if qr_roi is not None:
+            for rotation in (cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE):
+                if number := _number_from_qr(cv2.rotate(qr_roi, rotation)):
+                    break
+            started = _lap(timings, "qr_rotate", started)
+            if number: return number
+
+        for roi in _find_digit_rois(small, scale, gray):
+            if number := _ocr_digits(roi):
+                break
+        started = _lap(timings, "ocr_roi", started)
+        if number: return number
+
+        if match := NUMBER_PATTERN.search(_ocr(gray, digits_only=False)):
+            number = match.group(0)
+        _lap(timings, "ocr_full", started)
+        return number
+    except Exception as e:
+        logging.error(f"Ошибка при обработке изображения: {e}")
+    return None
+
+
+def _recognize_shared(shm_name: str, size: int) -> Tuple[Optional[str], Dict[str, float]]:
+    """
+    Задача рабочего процесса: фото лежит в разделяемой памяти, созданной ботом.
+    Процесс декодирует его прямо из этого буфера, без копии через pickle.
+    Возвращает номер (или None) и длительности этапов в мс.
+    """
+    timings: Dict[str, float] = {}
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name)
+    except FileNotFoundError:
+        # Бот уже не ждет результат (таймаут) и освободил память
+        return None, timings
+    started = time.perf_counter()
+    try:
+        image = decode_image(shm.buf[:size])
+    finally:
+        shm.close()
+    _lap(timings, "decode", started)
+    return extract_number_from_image(image, timings), timings
+
+
+def start_recognition_pool(workers: int = config.OCR_WORKERS):
+    """Запускает пул распознавания и дожидается, пока все процессы загрузят библиотеки."""
+    global _pool, _pool_workers
+    if _pool is not None:
+        return
+    # spawn, а не fork: в боте уже работают потоки (aiosqlite, executor), а fork их состояние не переносит.
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(config.TESSERACT_CMD,))
+    replies = dict(future.result() for future in [pool.submit(_ping) for _ in range(workers)])
+    _pool, _pool_workers = pool, workers
+    engines = sorted(set(replies.values()))
+    logging.info(f"Пул распознавания запущен: процессов {len(replies)}, OCR: {', '.join(engines)}.")
+
+
+def _terminate_pool(pool: ProcessPoolExecutor):
+    """Останавливает пул, не дожидаясь задач: зависший процесс иначе так и занимал бы ядро."""
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_recognition_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def _restart_pool(failed: ProcessPoolExecutor, reason: str):
+    """
+    Заменяет пул failed новым. Если пул уже заменил другой запрос, ничего не делает.
+    Задачи, еще шедшие в старом пуле, получат BrokenProcessPool и повторятся в новом.
+    """
+    global _pool
+    async with _pool_lock:
+        if _pool is not failed:
+            return
+        logging.error(f"Перезапуск пула распознавания: {reason}.")
+        _pool = None
+        _terminate_pool(failed)
+        await asyncio.get_running_loop().run_in_executor(None, start_recognition_pool, _pool_workers)
+
+
+async def _submit(image_bytes, size: int) -> Tuple[ProcessPoolExecutor, asyncio.Future]:
+    """
+    Кладет фото в разделяемую память и отдает задачу пулу. Место в очереди и память освобождаются,
+    когда задача действительно закончилась в рабочем процессе, а не когда бот перестал ее ждать.
+    """
+    global _pending_jobs
+    async with _pool_lock:  # Пока пул перезапускается, новые задачи ждут его здесь
+        pool = _pool
+    if pool is None:
+        raise RuntimeError("Пул распознавания не запущен: сначала вызовите start_recognition_pool().")
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        shm.buf[:size] = image_bytes
+        future = asyncio.get_running_loop().run_in_executor(pool, _recognize_shared, shm.name, size)
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    _pending_jobs += 1
+
+    def release(done: asyncio.Future):
+        global _pending_jobs
+        if not done.cancelled():
+            done.exception()  # Результат брошенной по таймауту задачи никто не заберет: не пишем об этом в лог
+        _pending_jobs -= 1
+        shm.close()
+        shm.unlink()
+
+    future.add_done_callback(release)
+    return pool, future
+
+
+async def recognize_number(image_bytes) -> Optional[str]:
+    """
+    Распознает номер самоката на фото (сжатые байты JPEG/PNG) в пуле процессов.
+    Байты передаются рабочему процессу через разделяемую память, файлы на диске не создаются.
+    Бросает RecognitionBusy, если в очереди уже OCR_QUEUE_LIMIT фото;
+    возвращает None, если номер не найден или распознавание не уложилось в OCR_TIMEOUT секунд.
+    Если рабочий процесс упал, пул перезапускается и фото распознается еще раз.
+    """
+    if _pending_jobs >= config.OCR_QUEUE_LIMIT:
+        raise RecognitionBusy()
+    size = len(image_bytes)
+    if not size:
+        return None
+
+    for attempt in (1, 2):
+        pool = _pool
+        try:
+            pool, future = await _submit(image_bytes, size)
+            number, timings = await asyncio.wait_for(asyncio.shield(future), timeout=config.OCR_TIMEOUT)
+        except BrokenProcessPool as e:
+            await _restart_pool(pool, f"рабочий процесс завершился аварийно ({e})")
+            if attempt == 2:
+                logging.error(f"Распознавание фото ({size} байт) не удалось и после перезапуска пула.")
+                return None
+            continue
+        except asyncio.TimeoutError:
+            # wait_for не останавливает процесс: без перезапуска зависший Tesseract так и держал бы его
+            logging.error(f"Распознавание фото ({size} байт) не уложилось в {config.OCR_TIMEOUT} с.")
+            await _restart_pool(pool, "задача зависла")
+            return None
+        stages = ", ".join(f"{stage} {ms:.0f}" for stage, ms in timings.items())
+        logging.info(f"Распознавание: {number or 'номер не найден'} за {sum(timings.values()):.0f} мс ({stages}).")
+        return number
+
+
+def content_hash(image_bytes) -> str:
+    """Хэш байтов файла: совпадает только у одинаковых файлов, в отличие от перцептивного хэша."""
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+async def _prune_disk_cache() -> int:
+    global _last_prune
+    _last_prune = time.monotonic()
+    return await db.prune_recognition_cache(time.time() - config.RECOGNITION_CACHE_TTL,
+                                            config.RECOGNITION_CACHE_DISK_SIZE)
+
+
+async def load_recognition_cache():
+    """Чистит устаревший кэш распознавания в БД и загружает в память самые свежие записи."""
+    pruned = await _prune_disk_cache()
+    rows = await db.load_recognition_cache(time.time() - config.RECOGNITION_CACHE_TTL, config.RECOGNITION_CACHE_SIZE)
+    RECOGNITION_CACHE.load(
+        (file_unique_id, CachedRecognition(number, digest, user_id, created_at))
+        for file_unique_id, number, user_id, digest, created_at in rows
+    )
+    logging.info(f"Кэш распознавания: загружено {len(RECOGNITION_CACHE)} записей, удалено устаревших {pruned}.")
+
+
+async def _remember(file_unique_id: str, user_id: int, number: str, digest: Optional[str]):
+    created_at = time.time()
+    RECOGNITION_CACHE.put(file_unique_id, CachedRecognition(number, digest, user_id, created_at))
+    try:
+        await db.save_recognition_result(file_unique_id, user_id, number, digest, created_at)
+        # Кэш в БД растет с каждым фото, поэтому чистится не только при запуске, но и по ходу работы
+        if time.monotonic() - _last_prune >= config.RECOGNITION_CACHE_PRUNE_INTERVAL:
+            await _prune_disk_cache()
+    except Exception as e:
+        # Кэш — только ускорение: скан уже распознан и будет сохранен в любом случае
+        logging.error(f"Не удалось сохранить результат распознавания в кэш: {e}")
+
+
+async def recognize_photo(user_id: int, file_unique_id: str,
+                          download: Callable[[], Awaitable[bytes]]) -> Optional[str]:
+    """
+    Номер самоката на фото с учетом кэша. download вызывается, только если номера нет в кэше
+    по file_unique_id. Исключения те же, что у recognize_number().
+    """
+    min_created_at = time.time() - config.RECOGNITION_CACHE_TTL
+    if number := RECOGNITION_CACHE.get(file_unique_id, min_created_at):
+        RECOGNITION_METRICS["memory_hits"] += 1
+        return number
+    if row := await db.get_cached_recognition(file_unique_id, min_created_at):
+        number, owner_id, digest, created_at = row
+        RECOGNITION_CACHE.put(file_unique_id, CachedRecognition(number, digest, owner_id, created_at))
+        RECOGNITION_METRICS["disk_hits"] += 1
+        return number
+
+    image_bytes = await download()
+    digest = content_hash(image_bytes)
+    number = (RECOGNITION_CACHE.get_by_content(digest, min_created_at)
+              or await db.get_cached_recognition_by_content(digest, min_created_at))
+    if number:
+        RECOGNITION_METRICS["content_hits"] += 1
+        await _remember(file_unique_id, user_id, number, digest)
+        return number
+
+    RECOGNITION_METRICS["misses"] += 1
+    number = await recognize_number(image_bytes)
+    if number:
+        await _remember(file_unique_id, user_id, number, digest)
+    return number
@@ -0,0 +1,70 @@
+# Файл: recognition_cache.py (кэш результатов распознавания фото в памяти процесса)
+
+from collections import OrderedDict
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+
+class CachedRecognition(NamedTuple):
+    scooter_number: str
+    content_hash: Optional[str]
+    user_id: int
+    created_at: float
+
+
+class RecognitionCache:
+    """
+    LRU-кэш "file_unique_id фото -> номер самоката" с ограничением по размеру.
+    Для того же фото, пришедшего с другим file_unique_id, есть поиск по хэшу содержимого:
+    номер переиспользуется только для байт-в-байт одинакового файла. Похожие кадры (перцептивный хэш)
+    не годятся: снимки разных самокатов одного места отличаются лишь цифрами номера.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, CachedRecognition]" = OrderedDict()
+        self._by_content: Dict[str, str] = {}  # Хэш содержимого -> file_unique_id
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _get_entry(self, file_unique_id: str, min_created_at: float) -> Optional[CachedRecognition]:
+        entry = self._entries.get(file_unique_id)
+        if entry is None:
+            return None
+        if entry.created_at < min_created_at:
+            self._remove(file_unique_id)
+            return None
+        self._entries.move_to_end(file_unique_id)
+        return entry
+
+    def get(self, file_unique_id: str, min_created_at: float) -> Optional[str]:
+        """Номер для фото или None, если записи нет или она старше min_created_at."""
+        entry = self._get_entry(file_unique_id, min_created_at)
+        return entry.scooter_number if entry else None
+
+    def get_by_content(self, content_hash: str, min_created_at: float) -> Optional[str]:
+        """Номер для фото с таким же содержимым или None."""
+        file_unique_id = self._by_content.get(content_hash)
+        if file_unique_id is None:
+            return None
+        entry = self._get_entry(file_unique_id, min_created_at)
+        return entry.scooter_number if entry else None
+
+    def _remove(self, file_unique_id: str):
+        entry = self._entries.pop(file_unique_id)
+        if entry.content_hash is not None and self._by_content.get(entry.content_hash) == file_unique_id:
+            del self._by_content[entry.content_hash]
+
+    def put(self, file_unique_id: str, entry: CachedRecognition):
+        if file_unique_id in self._entries:
+            self._remove(file_unique_id)
+        self._entries[file_unique_id] = entry
+        if entry.content_hash is not None:
+            self._by_content[entry.content_hash] = file_unique_id
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def load(self, rows: Iterable[Tuple[str, CachedRecognition]]):
+        """Заполняет кэш записями с диска (от старых к новым, чтобы новые оказались последними в LRU)."""
+        for file_unique_id, entry in rows:
+            self.put(file_unique_id, entry)
@@ -0,0 +1,97 @@
+# Файл: roster.py (импорт сотрудников и графика смен из grafik.json и employees.json в базу)
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+import database as db
+import employees
+from config import EMPLOYEES_PATH, GRAFIK_PATH, USER_REGISTRY_CHECK_INTERVAL
+
+# Время модификации файлов на момент последнего импорта: без изменений повторно ничего не пишется
+_imported_mtimes: Dict[str, int] = {}
+_checked_at = float("-inf")
+_sync_lock: Optional[asyncio.Lock] = None
+
+
+def _mtime_ns(path) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+async def import_grafik(path=GRAFIK_PATH) -> int:
+    """Переносит сотрудников и их смены из grafik.json в таблицы roster и shifts. Возвращает число смен."""
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    await db.import_roster([
+        (int(user_id), data.get("name", ""), data.get("short_name", "Неизвестный"), data.get("role", ""),
+         data.get("permissions", "none"))
+        for user_id, data in raw.items()
+    ])
+    shift_rows = [(day, int(user_id), shift_type)
+                  for user_id, data in raw.items() for day, shift_type in data.get("shifts", {}).items()]
+    await db.import_shifts(shift_rows, (int(user_id) for user_id in raw))
+    logging.info(f"Из {path} импортировано сотрудников: {len(raw)}, смен: {len(shift_rows)}.")
+    return len(shift_rows)
+
+
+async def import_employees(path=EMPLOYEES_PATH) -> int:
+    """Переносит имена и фамилии из employees.json в таблицу roster. Возвращает число сотрудников."""
+    staff = employees.load_employees(path)
+    await db.import_employee_names([(emp["id"], emp["first_name"], emp["last_name"]) for emp in staff.values()])
+    logging.info(f"Из {path} импортировано сотрудников: {len(staff)}.")
+    return len(staff)
+
+
+async def sync_roster(force: bool = False):
+    """
+    Импортирует grafik.json и employees.json, если они изменились с прошлого импорта.
+    Файлы проверяются не чаще раза в USER_REGISTRY_CHECK_INTERVAL секунд, как и в реестре пользователей.
+    """
+    global _checked_at, _sync_lock
+    now = time.monotonic()
+    if not force and now - _checked_at < USER_REGISTRY_CHECK_INTERVAL:
+        return
+    if _sync_lock is None:
+        _sync_lock = asyncio.Lock()
+    async with _sync_lock:
+        _checked_at = now
+        for path, importer in ((GRAFIK_PATH, import_grafik), (EMPLOYEES_PATH, import_employees)):
+            mtime_ns = _mtime_ns(path)
+            if mtime_ns is None or _imported_mtimes.get(str(path)) == mtime_ns:
+                continue
+            try:
+                await importer(path)
+            except (OSError, ValueError, KeyError) as e:
+                # Файл могли поймать на середине записи: в базе остается прошлый импорт
+                logging.error(f"Не удалось импортировать {path}: {e}")
+                continue
+            _imported_mtimes[str(path)] = mtime_ns
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Импорт сотрудников и графика смен в базу бота.")
+    parser.add_argument("--day", help="После импорта показать, кто работает в этот день (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    await db.init_db()
+    try:
+        await sync_roster(force=True)
+        if args.day:
+            staff = await db.get_day_staff(args.day)
+            print(f"В графике на {args.day}: {len(staff)}")
+            for user_id, short_name, _ in staff:
+                print(f"  {short_name} ({user_id})")
+    finally:
+        await db.close_db()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    asyncio.run(main())
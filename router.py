@@ -0,0 +1,32 @@
+# Файл: router.py (маршрутизация текстовых сообщений бота одним обработчиком)
+
+from typing import Awaitable, Callable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+Callback = Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable]
+
+
+class TextRouter:
+    """
+    Единственный обработчик текстовых сообщений вместо цепочки MessageHandler с regex-фильтрами.
+    Доступ проверяется по множеству разрешенных чатов (is_allowed), кнопка ищется в словаре по точному тексту,
+    все остальное (номер самоката, текст рассылки) уходит в fallback.
+    """
+
+    def __init__(self, buttons: Dict[str, Callback], fallback: Callback, is_allowed: Callable[[int], bool]):
+        self._buttons = dict(buttons)
+        self._fallback = fallback
+        self._is_allowed = is_allowed
+
+    def resolve(self, chat_id: int, text: str) -> Optional[Callback]:
+        """Обработчик для сообщения или None, если чату бот не отвечает."""
+        if not self._is_allowed(chat_id):
+            return None
+        return self._buttons.get(text, self._fallback)
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        callback = self.resolve(update.effective_chat.id, update.message.text)
+        if callback is not None:
+            await callback(update, context)
@@ -0,0 +1,64 @@
+# Файл: update_processor.py (параллельная обработка апдейтов с сохранением порядка для каждого пользователя)
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Верхняя граница python-telegram-bot на число апдейтов "в работе". Она берется до do_process_update,
+# поэтому настоящий общий лимит стоит внутри, уже после очереди пользователя: иначе апдейты,
+# ждущие своей очереди за чужим медленным фото, занимали бы общие места.
+MAX_PENDING_UPDATES = 10000
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейты разных пользователей обрабатываются параллельно, а апдейты одного пользователя — строго
+    по очереди, в порядке поступления. Порядок ограничений: очередь пользователя -> лимит класса
+    апдейта (например, OCR или отчеты) -> общий лимит max_concurrent.
+    """
+
+    def __init__(self, max_concurrent: int, class_limits: Dict[str, int],
+                 classify: Callable[[Update], Optional[str]]):
+        super().__init__(MAX_PENDING_UPDATES)
+        self._global = asyncio.BoundedSemaphore(max_concurrent)
+        self._class_slots = {name: asyncio.BoundedSemaphore(limit) for name, limit in class_limits.items()}
+        self._classify = classify
+        # user_id -> [замок очереди, сколько апдейтов пользователя ждут или обрабатываются]
+        self._user_queues: Dict[int, list] = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await self._run(update, coroutine)
+            return
+
+        queue = self._user_queues.get(user.id)
+        if queue is None:
+            queue = self._user_queues[user.id] = [asyncio.Lock(), 0]
+        queue[1] += 1
+        try:
+            # asyncio.Lock отдает замок в порядке ожидания, поэтому апдейты пользователя не обгоняют друг друга
+            async with queue[0]:
+                await self._run(update, coroutine)
+        finally:
+            queue[1] -= 1
+            if not queue[1]:
+                del self._user_queues[user.id]
+
+    async def _run(self, update: object, coroutine: Awaitable[Any]):
+        class_slots = self._class_slots.get(self._classify(update)) if isinstance(update, Update) else None
+        if class_slots is None:
+            async with self._global:
+                await coroutine
+            return
+        async with class_slots:
+            async with self._global:
+                await coroutine
@@ -0,0 +1,116 @@
+# Файл: user_registry.py (реестр пользователей из grafik.json с перезагрузкой при изменении файла)
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+
+class UserRecord:
+    """Один пользователь из grafik.json. Смены сюда не загружаются: они лежат в таблице shifts (см. roster.py)."""
+    __slots__ = ("user_id", "name", "short_name", "role", "permissions", "sheet_cols")
+
+    def __init__(self, user_id: int, data: Dict):
+        self.user_id = user_id
+        self.name: str = data.get("name", "")
+        self.short_name: str = data.get("short_name", "Неизвестный")
+        self.role: str = data.get("role", "")
+        self.permissions: str = data.get("permissions", "none")
+        cols = data.get("g_sheet_cols")
+        self.sheet_cols: Optional[Tuple[int, int]] = tuple(cols) if cols else None
+
+
+class _Snapshot(NamedTuple):
+    users: Dict[int, UserRecord]
+    allowed: FrozenSet[int]
+    special: FrozenSet[int]  # admin и special
+    admins: FrozenSet[int]
+    mtime_ns: int
+
+
+_EMPTY = _Snapshot({}, frozenset(), frozenset(), frozenset(), 0)
+
+
+class UserRegistry:
+    """
+    Пользователи бота по int ID с заранее посчитанными множествами прав.
+    Файл перечитывается, только если изменилось его время модификации, и проверяется это
+    не чаще раза в check_interval секунд. Новый снимок собирается целиком и подменяется одним
+    присваиванием, поэтому читатели (в том числе потоки веб-сервера) не видят наполовину загруженных данных.
+    """
+
+    def __init__(self, path, check_interval: float):
+        self.path = path
+        self.check_interval = check_interval
+        self._snapshot = _EMPTY
+        self._checked_at = float("-inf")
+        self._reload_lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> bool:
+        """Перечитывает файл, если он изменился. Возвращает True, если данные обновились."""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return False
+        with self._reload_lock:
+            self._checked_at = now
+            try:
+                mtime_ns = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                logging.error(f"Критическая ошибка: Файл с данными пользователей не найден по пути {self.path}")
+                return False
+            if mtime_ns == self._snapshot.mtime_ns:
+                return False
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    raw = json.load(f)
+            except (OSError, ValueError) as e:
+                # Файл могли поймать на середине записи: оставляем прежние данные и попробуем в следующий раз
+                logging.error(f"Не удалось прочитать {self.path}: {e}")
+                return False
+            users = {int(user_id): UserRecord(int(user_id), data) for user_id, data in raw.items()}
+            self._snapshot = _Snapshot(
+                users=users,
+                allowed=frozenset(users),
+                special=frozenset(uid for uid, user in users.items() if user.permissions in ("admin", "special")),
+                admins=frozenset(uid for uid, user in users.items() if user.permissions == "admin"),
+                mtime_ns=mtime_ns,
+            )
+        logging.info(f"Реестр пользователей загружен: {len(users)} записей.")
+        return True
+
+    def _current(self) -> _Snapshot:
+        self.refresh()
+        return self._snapshot
+
+    def __len__(self) -> int:
+        return len(self._current().users)
+
+    def get(self, user_id: int) -> Optional[UserRecord]:
+        return self._current().users.get(user_id)
+
+    def all(self) -> List[UserRecord]:
+        return list(self._current().users.values())
+
+    def name(self, user_id: int, default: Optional[str] = None) -> str:
+        user = self._current().users.get(user_id)
+        if user is not None:
+            return user.short_name
+        return default if default is not None else f"ID {user_id}"
+
+    def permissions(self, user_id: int) -> str:
+        user = self._current().users.get(user_id)
+        return user.permissions if user else "none"
+
+    def is_allowed(self, user_id: int) -> bool:
+        return user_id in self._current().allowed
+
+    def is_special(self, user_id: int) -> bool:
+        return user_id in self._current().special
+
+    def is_admin(self, user_id: int) -> bool:
+        return user_id in self._current().admins
+
+    def ids_with_permission(self, permissions: str) -> List[int]:
+        return [uid for uid, user in self._current().users.items() if user.permissions == permissions]
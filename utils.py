@@ -1,6 +1,5 @@
 # Файл: utils.py (Версия с интеграцией Web App для кнопки "Моя статистика")
 
-import json
 import os
 from pathlib import Path
 from typing import Dict, Optional
@@ -8,7 +7,9 @@ from telegram import ReplyKeyboardMarkup, WebAppInfo, KeyboardButton
 from config import *
 
 # <<< Эта строка важна для функции get_user_shift_message >>>
-from database import get_last_activity
+from database import get_last_activity, get_user_shifts
+from roster import sync_roster
+from user_registry import UserRegistry
 
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
@@ -20,42 +21,30 @@ def now_moscow():
     return datetime.now(MOSCOW_TZ)
 
 
-# Глобальные переменные для кэширования данных о пользователях
-USER_DATA: Dict = {}
-USER_NAMES: Dict[int, str] = {}
+# Реестр пользователей из grafik.json: общий для бота и веб-сервера, сам перечитывает файл при изменении
+USERS = UserRegistry(GRAFIK_PATH, USER_REGISTRY_CHECK_INTERVAL)
 
 
 def load_user_data():
-    """Загружает данные пользователей из grafik.json и кэширует их."""
-    global USER_DATA, USER_NAMES
-    try:
-        with open(GRAFIK_PATH, "r", encoding="utf-8") as f:
-            USER_DATA = json.load(f)
-    except FileNotFoundError:
-        print(f"Критическая ошибка: Файл с данными пользователей не найден по пути {GRAFIK_PATH}")
-        return
-
-    for user_id_str, data in USER_DATA.items():
-        user_id = int(user_id_str)
-        USER_NAMES[user_id] = data.get("short_name", "Неизвестный")
+    """Загружает данные пользователей из grafik.json (сразу, без ожидания интервала проверки)."""
+    USERS.refresh(force=True)
 
 
 def get_user_permissions(user_id: int) -> str:
     """Возвращает уровень доступа пользователя."""
-    return USER_DATA.get(str(user_id), {}).get("permissions", "none")
+    return USERS.permissions(user_id)
 
 
 def is_user_allowed(user_id: int) -> bool:
-    return str(user_id) in USER_DATA
+    return USERS.is_allowed(user_id)
 
 
 def is_special_user(user_id: int) -> bool:
-    perms = get_user_permissions(user_id)
-    return perms in ["admin", "special"]
+    return USERS.is_special(user_id)
 
 
 def is_admin(user_id: int) -> bool:
-    return get_user_permissions(user_id) == "admin"
+    return USERS.is_admin(user_id)
 
 
 def get_user_reply_markup(user_id: int, in_broadcast_mode: bool = False) -> ReplyKeyboardMarkup:
@@ -108,12 +97,13 @@ def get_user_reply_markup(user_id: int, in_broadcast_mode: bool = False) -> Repl
 
 async def get_user_shift_message(user_id: int, days: int = 15) -> str:
     """Формирует сообщение о графике смен."""
-    user_id_str = str(user_id)
-    if user_id_str not in USER_DATA: return "Для вас график пока не назначен."
-    shifts = USER_DATA[user_id_str].get("shifts", {})
-    if not shifts: return "ℹ️ Для вас не задан график смен."
-
+    if not USERS.is_allowed(user_id): return "Для вас график пока не назначен."
     today = now_moscow().date()
+    await sync_roster()  # Подтягиваем изменения grafik.json, если файл правили без перезапуска
+    shifts = await get_user_shifts(user_id, today.strftime("%Y-%m-%d"),
+                                   (today + timedelta(days=days - 1)).strftime("%Y-%m-%d"))
+    if shifts is None: return "ℹ️ Для вас не задан график смен."
+
     # Вот здесь используется get_last_activity, поэтому импорт был важен
     last_activity_str = await get_last_activity(user_id)
     lines = ["🎯 *Ваш персональный график смен*  \n"]
@@ -167,7 +157,7 @@ def format_today_report_message(stats: Dict) -> str:
 
     for user_id in sorted_user_ids:
         data = users_data[user_id]
-        user_name = USER_NAMES.get(user_id, f"ID {user_id}")
+        user_name = USERS.name(user_id)
         count = data.get("count", 0)
         duplicates = data.get("duplicates", 0)
         last_add_str = data.get("last_add", "")
@@ -198,7 +188,7 @@ def format_decade_report_message(decade_num: int, stats: Dict) -> str:
     sorted_users = sorted(totals.items(), key=lambda item: item[1], reverse=True)
 
     for user_id, total in sorted_users:
-        user_name = USER_NAMES.get(user_id, f"ID {user_id}")
+        user_name = USERS.name(user_id)
         stats_lines.append(f"📌 {user_name} — {total}/{DECADE_NORM}")
         if total > DECADE_NORM:
             premium_amount = (total - DECADE_NORM) * PREMIUM_RATE
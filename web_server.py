@@ -1,25 +1,53 @@
 # Файл: web_server.py (НОВЫЙ ФАЙЛ)
 
+import asyncio
+import hashlib
+import hmac
 import json
 import logging
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
+from urllib.parse import parse_qsl
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, Response
 from zoneinfo import ZoneInfo
-from datetime import datetime, timedelta
+from datetime import datetime
+from typing import Dict, Optional, Tuple
 
 import database as db
 import utils
-from config import SIMULATED_YEAR
+from config import (BOT_TOKEN, SIMULATED_YEAR, STATS_CACHE_SIZE, STATS_SHELL_MAX_AGE, WEB_APP_AUTH_MAX_AGE,
+                    WEB_GZIP_MIN_SIZE)
 
 # --- Настройки ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - WEB - [%(levelname)s] - %(message)s")
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Открывает пул соединений с БД при старте и закрывает при остановке."""
+    await db.init_db()
+    yield
+    await db.close_db()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(GZipMiddleware, minimum_size=WEB_GZIP_MIN_SIZE)
 BASE_DIR = Path(__file__).resolve().parent
-templates = Jinja2Templates(directory=str(BASE_DIR))  # Ищем шаблоны в корне проекта
+# Оболочка страницы статистики не зависит от пользователя: читаем ее один раз, ETag — хэш содержимого
+STATS_SHELL = (BASE_DIR / "stats_template.html").read_text(encoding="utf-8")
+STATS_SHELL_ETAG = '"' + hashlib.sha1(STATS_SHELL.encode()).hexdigest()[:20] + '"'
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
 
+# user_id -> ((версия статистики, день), статистика с данными графиков).
+# Версию поднимают триггеры БД при каждом скане или импорте истории этого пользователя,
+# поэтому запись в кэше устаревает ровно тогда, когда меняются его данные (или наступает новый день).
+_stats_cache: Dict[int, Tuple[Tuple[int, str], Dict]] = {}
+# (версия статистики команды, день) -> итоги пользователей за сегодня; версию команды поднимает любой скан
+_team_cache: Optional[Tuple[Tuple[int, str], Dict]] = None
+
 
 def now_moscow():
     """Возвращает текущую дату с симулированным годом"""
@@ -32,114 +60,184 @@ def now_moscow():
     return now
 
 
-async def get_chart_data_for_user(user_id: int):
+def _telegram_user_id(init_data: str) -> Optional[int]:
     """
-    Собирает данные для графиков почасовой и недельной активности пользователя.
+    ID пользователя из initData Telegram Web App или None, если подпись не сходится или устарела.
+    Подпись — HMAC-SHA256 от полей запроса с ключом, выведенным из токена бота (так проверяет сам Telegram).
     """
-    now = now_moscow()
-    today_str = now.strftime("%Y-%m-%d")
-    seven_days_ago_str = (now - timedelta(days=6)).strftime("%Y-%m-%d")
-
-    async with db.aiosqlite.connect(db.DB_PATH) as conn:
-        # 1. Данные по часам за сегодня
-        hourly_labels = [f"{h:02d}" for h in range(24)]
-        hourly_values = [0] * 24
-        cursor = await conn.execute(
-            """
-            SELECT strftime('%H', timestamp) as hour, COUNT(*)
-            FROM scooter_log
-            WHERE user_id = ? AND date(timestamp) = ?
-            GROUP BY hour
-            """,
-            (user_id, today_str)
-        )
-        async for row in cursor:
-            hour_index = int(row[0])
-            hourly_values[hour_index] = row[1]
-
-        # 2. Данные по дням за последние 7 дней (из обеих таблиц)
-        weekly_labels = [(now - timedelta(days=i)).strftime('%d.%m') for i in range(6, -1, -1)]
-        weekly_values_dict = {label: 0 for label in weekly_labels}
-
-        # Данные из scooter_log
-        cursor = await conn.execute(
-            """
-            SELECT strftime('%d.%m', date(timestamp)) as day, COUNT(*)
-            FROM scooter_log
-            WHERE user_id = ? AND date(timestamp) >= ?
-            GROUP BY day
-            """,
-            (user_id, seven_days_ago_str)
-        )
-        async for row in cursor:
-            if row[0] in weekly_values_dict:
-                weekly_values_dict[row[0]] += row[1]
-
-        # Данные из historic_stats
-        cursor = await conn.execute(
-            """
-            SELECT strftime('%d.%m', log_date) as day, count
-            FROM historic_stats
-            WHERE user_id = ? AND log_date >= ?
-            """,
-            (user_id, seven_days_ago_str)
-        )
-        async for row in cursor:
-            if row[0] in weekly_values_dict:
-                weekly_values_dict[row[0]] += row[1]
-
-        weekly_values = [weekly_values_dict[label] for label in weekly_labels]
-
-    return {
-        "hourly_labels": hourly_labels,
-        "hourly_data": hourly_values,
-        "weekly_labels": weekly_labels,
-        "weekly_data": weekly_values,
-    }
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop("hash", "")
+    data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    expected_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected_hash, received_hash):
+        return None
+    try:
+        if time.time() - int(fields.get("auth_date", 0)) > WEB_APP_AUTH_MAX_AGE:
+            return None
+        return int(json.loads(fields["user"])["id"])
+    except (KeyError, TypeError, ValueError):
+        return None
 
 
-@app.get("/stats/{user_id}", response_class=HTMLResponse)
-async def get_user_stats_page(request: Request, user_id: int):
+async def require_admin(x_telegram_init_data: Optional[str] = Header(None)) -> int:
     """
-    Основная функция, которая собирает все данные и рендерит HTML-страницу.
+    Пускает только администраторов бота — ту же проверку, что и кнопка админ-панели в боте.
+    Web App передает свой initData в заголовке X-Telegram-Init-Data.
     """
-    utils.load_user_data()  # Убедимся, что данные о пользователях загружены
-    user_name = utils.USER_NAMES.get(user_id, "Неизвестный")
+    if not BOT_TOKEN:
+        logging.error("BOT_TOKEN не задан: подпись Telegram проверить нечем, админские запросы отклоняются.")
+        raise HTTPException(status_code=503, detail="Авторизация недоступна")
+    user_id = _telegram_user_id(x_telegram_init_data) if x_telegram_init_data else None
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Нужна авторизация через Telegram")
+    if not utils.is_admin(user_id):
+        raise HTTPException(status_code=403, detail="Доступ только для администраторов")
+    return user_id
+
+
+async def get_cached_user_stats(user_id: int, day: str) -> Tuple[int, Dict]:
+    """Статистика пользователя (db.get_user_stats) из кэша; пересчитывается, только если версия или день сменились."""
+    # Версию читаем до расчета: если скан придет во время расчета, следующий запрос увидит новую версию
+    version = await db.get_stats_version(user_id)
+    cached = _stats_cache.get(user_id)
+    if cached is not None and cached[0] == (version, day):
+        return version, cached[1]
+
+    stats = await db.get_user_stats(user_id)
+    _stats_cache.pop(user_id, None)
+    if len(_stats_cache) >= STATS_CACHE_SIZE:
+        del _stats_cache[next(iter(_stats_cache))]  # Вытесняем давно не пересчитанную запись
+    _stats_cache[user_id] = ((version, day), stats)
+    return version, stats
+
+
+async def get_cached_team_stats(day: str) -> Tuple[int, Dict]:
+    """Итоги команды за сегодня (db.get_report_stats) из кэша; пересчитываются после любого нового скана."""
+    global _team_cache
+    version = await db.get_stats_version(db.TEAM_STATS_VERSION_ID)
+    if _team_cache is not None and _team_cache[0] == (version, day):
+        return version, _team_cache[1]
+    today_users = (await db.get_report_stats("today"))["users"]
+    _team_cache = ((version, day), today_users)
+    return version, today_users
+
+
+def _etag(*parts) -> str:
+    return '"' + hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()[:20] + '"'
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    """True, если у клиента уже есть ответ с этим ETag (заголовок If-None-Match)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag in tags or "*" in tags
+
+
+def _api_headers(etag: str) -> Dict[str, str]:
+    # Клиент хранит ответ, но перед каждым использованием перепроверяет его по ETag
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def _json_response(request: Request, payload, etag: str) -> Response:
+    """Компактный JSON с ETag; при совпадении ETag — пустой 304."""
+    headers = _api_headers(etag)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.get("/api/stats/team", dependencies=[Depends(require_admin)])
+async def get_team_stats_api(request: Request):
+    """Статистика команды за сегодня и общий рейтинг (только для администраторов)."""
+    now = now_moscow()
+    (version, today_users), top = await asyncio.gather(
+        get_cached_team_stats(now.strftime("%Y-%m-%d")), db.get_leaderboard_top(10))
+    users = sorted(
+        ({"user_id": user_id, "name": utils.USERS.name(user_id), "count": data["count"],
+          "duplicates": data["duplicates"], "last_add": data["last_add"][11:16]}
+         for user_id, data in today_users.items()),
+        key=lambda user: user["count"], reverse=True
+    )
+    payload = {
+        "date": now.strftime("%d.%m.%Y"),
+        "today_total": sum(user["count"] for user in users),
+        "users": users,
+        "leaderboard": [{"place": place, "user_id": user_id, "name": utils.USERS.name(user_id), "total": total}
+                        for place, (user_id, total) in enumerate(top, start=1)],
+    }
+    # Имена берутся из реестра при каждом запросе, поэтому ETag считается по самому ответу:
+    # данные из БД при этом все равно берутся из кэша по версии команды
+    etag = _etag(version, json.dumps(payload, ensure_ascii=False, sort_keys=True))
+    return _json_response(request, payload, etag)
+
+
+@app.get("/api/stats/{user_id}")
+async def get_user_stats_api(request: Request, user_id: int):
+    """Все поля страницы статистики пользователя одним JSON."""
+    user_name = utils.USERS.name(user_id, "Неизвестный")  # Реестр сам перечитает grafik.json, если файл изменился
     try:
         user_first_name = user_name.split()[1]
     except IndexError:
         user_first_name = user_name
 
-    personal_stats = await db.get_personal_stats(user_id)
-    chart_data = await get_chart_data_for_user(user_id)
-
     now = now_moscow()
-    decade_start_day = 1 if now.day <= 10 else 11 if now.day <= 20 else 21
+    # Место в рейтинге зависит и от чужих сканов, поэтому берется из рейтинга в памяти при каждом запросе,
+    # параллельно с проверкой версии и (при промахе кэша) запросами статистики
+    (version, stats), overall_rank = await asyncio.gather(
+        get_cached_user_stats(user_id, now.strftime("%Y-%m-%d")), db.get_user_rank(user_id))
 
-    # Собираем все данные в один словарь (контекст) для передачи в шаблон
-    context = {
-        "request": request,
+    # Ответ однозначно определяется версией данных, днем, местом в рейтинге и именем:
+    # если они не изменились, клиенту хватит ответа 304 без сборки JSON
+    etag = _etag(user_id, version, now.strftime("%Y-%m-%d"), overall_rank, user_name)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers=_api_headers(etag))
+
+    decade_start_day = 1 if now.day <= 10 else 11 if now.day <= 20 else 21
+    payload = {
         "user_first_name": user_first_name,
         "current_date": now.strftime("%d.%m.%Y"),
-        "today_count": personal_stats.get('today_count', 0),
-        "avg_time_today": "N/A",  # Эту метрику нужно будет вычислить дополнительно, если нужно
-        "duplicates_today": personal_stats.get('today_duplicates', 0),
+        "today_count": stats["today_count"],
+        "avg_time_today": stats["avg_time_today"],
+        "duplicates_today": stats["today_duplicates"],
         "rank_today": "N/A",  # Эту метрику тоже нужно будет вычислить
         "total_users_today": "N/A",
         "decade_dates": f"{decade_start_day:02d}.{now.month:02d} - {now.day:02d}.{now.month:02d}",
-        "decade_progress": personal_stats.get('decade_total', 0),
+        "decade_progress": stats["decade_total"],
         "decade_norm": db.DECADE_NORM,
-        "remaining_for_premium": max(0, db.DECADE_NORM - personal_stats.get('decade_total', 0)),
-        "overall_total": personal_stats.get('overall_total', 0),
-        "best_day_count": personal_stats.get('best_day_count', 0),
-        "best_day_date": personal_stats.get('best_day_date', 'N/A'),
-        "overall_rank": personal_stats.get('rank', 'N/A'),
-        # Данные для JS, преобразуем в JSON-строку
-        "hourly_labels_js": json.dumps(chart_data["hourly_labels"]),
-        "hourly_data_js": json.dumps(chart_data["hourly_data"]),
-        "weekly_labels_js": json.dumps(chart_data["weekly_labels"]),
-        "weekly_data_js": json.dumps(chart_data["weekly_data"]),
+        "remaining_for_premium": max(0, db.DECADE_NORM - stats["decade_total"]),
+        "overall_total": stats["overall_total"],
+        "best_day_count": stats["best_day_count"],
+        "best_day_date": stats["best_day_date"],
+        "overall_rank": overall_rank,
+        "hourly_data": stats["hourly_data"],  # Подписи по часам (00..23) страница строит сама
+        "weekly_labels": stats["weekly_labels"],
+        "weekly_data": stats["weekly_data"],
     }
+    return _json_response(request, payload, etag)
+
 
+@app.get("/stats/{user_id}", response_class=HTMLResponse)
+async def get_user_stats_page(request: Request, user_id: int):
+    """
+    Страница статистики: статичная оболочка, которая сама загружает данные из /api/stats/{user_id}.
+    Одна и та же для всех пользователей, поэтому браузер берет ее из своего кэша.
+    """
+    headers = {"ETag": STATS_SHELL_ETAG, "Cache-Control": f"public, max-age={STATS_SHELL_MAX_AGE}"}
+    if _not_modified(request, STATS_SHELL_ETAG):
+        return Response(status_code=304, headers=headers)
     logging.info(f"Отдаю страницу статистики для пользователя {user_id}")
-    return templates.TemplateResponse("stats_template.html", context)
\ No newline at end of file
+    return HTMLResponse(STATS_SHELL, headers=headers)
+
+
+@app.get("/admin/leaderboard", dependencies=[Depends(require_admin)])
+async def get_leaderboard(limit: int = 10):
+    """Первые места общего рейтинга для админ-панели."""
+    top = await db.get_leaderboard_top(limit)
+    return [
+        {"place": place, "user_id": user_id, "name": utils.USERS.name(user_id), "total": total}
+        for place, (user_id, total) in enumerate(top, start=1)
+    ]